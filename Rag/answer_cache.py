@@ -0,0 +1,214 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "cache/answer_cache.sqlite3")
+# cosine similarity above which two questions count as the same question
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.93))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 7 * 24 * 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 10000))
+
+
+class SemanticAnswerCache:
+    """
+    Answers by the embedding of the question they were given for. A lookup returns the stored
+    answer of the most similar earlier question above threshold, asked in the same context (model,
+    prompt and retrieval scope). Every entry records the chunks and documents it was grounded on
+    and is dropped when one of them is re-ingested or deleted; entries also expire after ttl, and
+    the least recently used go first beyond max_entries.
+
+    Entries live in sqlite so they survive restarts and every process sees the invalidations;
+    the embeddings are searched in memory and new rows are picked up on the next lookup.
+    """
+
+    def __init__(self, path: str = ANSWER_CACHE_PATH, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 ttl: float = ANSWER_CACHE_TTL, max_entries: int = ANSWER_CACHE_MAX_ENTRIES) -> None:
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY AUTOINCREMENT, context TEXT NOT NULL, query TEXT NOT NULL, "
+                          "embedding BLOB NOT NULL, answer TEXT NOT NULL, chunk_ids TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        # which entries rest on which chunk and document, for the invalidation
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sources (entry INTEGER NOT NULL, chunk_id TEXT NOT NULL, doc_name TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sources_chunk ON sources (chunk_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sources_doc ON sources (doc_name)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sources_entry ON sources (entry)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('invalidated', 0), ('expired', 0), ('evicted', 0)")
+
+        # in-memory copy of the entries' embeddings, rows up to loaded_until
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.contexts = []
+        self.embeddings = None
+        self.loaded_until = 0
+
+
+    def _increment(self, name: str, amount: int = 1) -> None:
+        self.conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (amount, name))
+
+
+    def _load_new(self) -> None:
+        rows = self.conn.execute("SELECT id, context, embedding FROM entries WHERE id > ? ORDER BY id", (self.loaded_until,)).fetchall()
+        if not rows:
+            return
+        vectors = np.stack([np.frombuffer(embedding, dtype=np.float32) for _, _, embedding in rows])
+        self.ids = np.concatenate([self.ids, np.array([id for id, _, _ in rows], dtype=np.int64)])
+        self.contexts.extend(context for _, context, _ in rows)
+        self.embeddings = vectors if self.embeddings is None else np.concatenate([self.embeddings, vectors])
+        self.loaded_until = rows[-1][0]
+
+
+    def _forget(self, ids: set) -> None:
+        keep = np.array([id not in ids for id in self.ids.tolist()], dtype=bool)
+        self.ids = self.ids[keep]
+        self.contexts = [context for context, kept in zip(self.contexts, keep) if kept]
+        self.embeddings = self.embeddings[keep] if self.embeddings is not None else None
+
+
+    def _delete(self, ids: list, counter: str) -> None:
+        if not ids:
+            return
+        self.conn.executemany("DELETE FROM entries WHERE id = ?", [(id,) for id in ids])
+        self.conn.executemany("DELETE FROM sources WHERE entry = ?", [(id,) for id in ids])
+        self._increment(counter, len(ids))
+        self._forget(set(ids))
+
+
+    def lookup(self, query_embedding, context: str):
+        """
+        Returns {"answer", "query", "chunk_ids", "doc_names", "similarity"} of the closest cached question, or None.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        now = time.time()
+
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._load_new()
+                found = None
+                if self.embeddings is not None and len(self.ids):
+                    similarities = self.embeddings @ query
+                    similarities[[entry_context != context for entry_context in self.contexts]] = -1
+                    gone = set()
+                    # best first; an entry another process dropped is skipped for the next one
+                    for i in np.argsort(-similarities):
+                        if similarities[i] < self.threshold:
+                            break
+                        id = int(self.ids[i])
+                        row = self.conn.execute("SELECT query, answer, chunk_ids, created FROM entries WHERE id = ?", (id,)).fetchone()
+                        if row is None:
+                            gone.add(id)
+                            continue
+                        if row[3] + self.ttl < now:
+                            gone.add(id)
+                            self.conn.execute("DELETE FROM entries WHERE id = ?", (id,))
+                            self.conn.execute("DELETE FROM sources WHERE entry = ?", (id,))
+                            self._increment("expired")
+                            continue
+                        self.conn.execute("UPDATE entries SET last_used = ? WHERE id = ?", (now, id))
+                        doc_names = dict(self.conn.execute("SELECT chunk_id, doc_name FROM sources WHERE entry = ?", (id,)).fetchall())
+                        chunk_ids = json.loads(row[2])
+                        found = {"query": row[0], "answer": row[1], "chunk_ids": chunk_ids, "doc_names": [doc_names.get(chunk_id) for chunk_id in chunk_ids],
+                                 "similarity": round(float(similarities[i]), 4)}
+                        break
+                    self._forget(gone)
+
+                self._increment("hits" if found else "misses")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return found
+
+
+    def store(self, query: str, query_embedding, context: str, answer: str, chunk_ids: list, doc_names: list) -> None:
+        # an answer that isn't grounded on any chunk could never be invalidated, it isn't cached
+        if not chunk_ids:
+            return
+        embedding = np.asarray(query_embedding, dtype=np.float32)
+        embedding = embedding / (np.linalg.norm(embedding) or 1)
+        now = time.time()
+
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute("INSERT INTO entries (context, query, embedding, answer, chunk_ids, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                           (context, query, embedding.tobytes(), answer, json.dumps(chunk_ids), now, now))
+                self.conn.executemany("INSERT INTO sources VALUES (?, ?, ?)",
+                                      [(cursor.lastrowid, chunk_id, doc_name) for chunk_id, doc_name in zip(chunk_ids, doc_names)])
+                self._evict(now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+
+    def _evict(self, now: float) -> None:
+        expired = [id for (id,) in self.conn.execute("SELECT id FROM entries WHERE created < ?", (now - self.ttl,))]
+        self._delete(expired, "expired")
+        excess = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._delete([id for (id,) in self.conn.execute("SELECT id FROM entries ORDER BY last_used LIMIT ?", (excess,))], "evicted")
+
+
+    def invalidate(self, doc_names: list = (), chunk_ids: list = ()) -> int:
+        """
+        Drops the entries grounded on any of the documents or chunks, returns how many.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = set()
+                for field, values in (("doc_name", doc_names), ("chunk_id", chunk_ids)):
+                    values = list(values)
+                    # sqlite allows 999 parameters per statement
+                    for start in range(0, len(values), 500):
+                        part = values[start:start + 500]
+                        ids.update(id for (id,) in self.conn.execute(
+                            f"SELECT DISTINCT entry FROM sources WHERE {field} IN ({', '.join('?' * len(part))})", part))
+                self._delete(list(ids), "invalidated")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return len(ids)
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = dict(self.conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "ttl_seconds": self.ttl,
+            **counters,
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+        }
+
+
+_answer_cache = None
+
+def get_answer_cache() -> SemanticAnswerCache:
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = SemanticAnswerCache()
+    return _answer_cache
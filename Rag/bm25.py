@@ -0,0 +1,393 @@
+import asyncio
+import heapq
+import math
+import os
+import pickle
+import re
+import sys
+import threading
+import uuid
+from filelock import FileLock
+
+
+BM25_INDEX_PATH = os.getenv("BM25_INDEX_PATH", "cache/bm25_index.pickle")
+BM25_K1 = float(os.getenv("BM25_K1", 1.5))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+# constant of reciprocal rank fusion, 60 is the value from the original paper
+RRF_K = int(os.getenv("RRF_K", 60))
+# journal size above which a save writes a new snapshot instead
+BM25_JOURNAL_MAX_BYTES = int(os.getenv("BM25_JOURNAL_MAX_BYTES", 64 * 1024 * 1024))
+
+# bump when tokenize or the stored state changes, an index written by another version is rebuilt
+INDEX_VERSION = 2
+
+# metadata fields searches can be restricted to, each has an index value -> chunk ids
+FILTER_FIELDS = ("doc_name", "category")
+
+# identifiers like "HR-12", "4.2.1" or "LTC/ADV" are one token, their parts are indexed as well
+TOKEN = re.compile(r"[a-z0-9]+(?:[-./][a-z0-9]+)*")
+PART = re.compile(r"[a-z0-9]+")
+STOPWORDS = {"a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "is", "are", "be", "by",
+             "with", "as", "at", "it", "this", "that", "from", "what", "which", "who", "how", "do", "does"}
+
+
+def tokenize(text: str) -> list:
+    tokens = []
+    for token in TOKEN.findall(text.lower()):
+        parts = PART.findall(token)
+        if len(parts) > 1:
+            tokens.append(token)
+        tokens.extend(part for part in parts if part not in STOPWORDS)
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    # rankings are lists of ids, best first; returns (id, score) best first
+    scores = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    """
+    Inverted index over the stored chunks for keyword (BM25) search next to the vector search.
+    Chunks are added and removed as documents are ingested, so updates touch only that document's
+    postings. The index is kept in memory and persisted as a pickled snapshot at path plus a journal
+    of the changes since: save() appends this process's changes under a file lock, so workers
+    saving at the same time all keep theirs, and the changes other processes journaled are picked
+    up on the next search. A journal grown past BM25_JOURNAL_MAX_BYTES is folded into a new snapshot.
+    """
+
+    def __init__(self, path: str = BM25_INDEX_PATH, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.lock_path = f"{path}.lock"
+        if os.path.dirname(self.lock_path):
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        # between processes; always taken after self.lock
+        self.file_lock = FileLock(self.lock_path)
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        # changes made in this process that are not in the journal yet
+        self.pending = []
+        self.generation = None
+        self.journal_inode = None
+        self.journal_offset = 0
+        self._reset()
+        self.load()
+
+
+    def _reset(self) -> None:
+        self.postings = {}       # term -> {chunk id: term frequency}
+        self.lengths = {}        # chunk id -> number of tokens
+        self.chunk_terms = {}    # chunk id -> its distinct terms, to remove it again
+        self.fields = {field: {} for field in FILTER_FIELDS}  # field -> value -> chunk ids
+        self.chunk_fields = {}   # chunk id -> {field: value}
+        self.total_length = 0
+
+
+    def load(self) -> None:
+        with self.lock, self.file_lock:
+            self._load()
+
+
+    def _load(self) -> None:
+        # the snapshot, the journal written since, then what this process hasn't journaled yet
+        self._reset()
+        self.generation, self.journal_inode, self.journal_offset = None, None, 0
+        try:
+            with open(self.path, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            state = None
+        except Exception as e:
+            print(f"could not load bm25 index {self.path} ({e}), rebuild it with python -m Rag.bm25 rebuild")
+            state = None
+        if state is not None and state.get("version") != INDEX_VERSION:
+            print(f"bm25 index {self.path} is from another version, rebuild it with python -m Rag.bm25 rebuild")
+            state = None
+        if state is not None:
+            for field in ("postings", "lengths", "chunk_terms", "fields", "chunk_fields", "total_length"):
+                setattr(self, field, state[field])
+            self.generation = state.get("generation")
+        self._replay()
+        for record in self.pending:
+            self._apply(record)
+
+
+    def _replay(self) -> None:
+        # applies the journal records after journal_offset
+        try:
+            f = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self.journal_inode:
+                try:
+                    header = pickle.load(f)
+                except Exception:
+                    return
+                # a journal left from before the snapshot was written is already in it
+                if header.get("generation") is None or header.get("generation") != self.generation:
+                    return
+                self.journal_inode, self.journal_offset = inode, f.tell()
+            f.seek(self.journal_offset)
+            while True:
+                try:
+                    record = pickle.load(f)
+                except Exception:
+                    # the end, or the torn last record of a process that died writing it
+                    return
+                self._apply(record)
+                self.journal_offset = f.tell()
+
+
+    def _sync(self) -> None:
+        try:
+            inode = os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != self.journal_inode:
+            # a new snapshot was written
+            self._load()
+        else:
+            self._replay()
+
+
+    def reload_if_changed(self) -> None:
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino == self.journal_inode and stat.st_size <= self.journal_offset:
+            return
+        with self.lock, self.file_lock:
+            self._sync()
+
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.pending:
+                return
+            with self.file_lock:
+                self._sync()
+                if self.journal_inode is None:
+                    self._compact()
+                    return
+                with open(self.journal_path, "ab") as f:
+                    # anything past what _replay could read is a torn record, it would hide every later one
+                    f.truncate(self.journal_offset)
+                    f.write(b"".join(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL) for record in self.pending))
+                    self.journal_offset = f.tell()
+                self.pending = []
+                if self.journal_offset > BM25_JOURNAL_MAX_BYTES:
+                    self._compact()
+
+
+    def _compact(self) -> None:
+        # writes the whole index as a new snapshot with an empty journal, both under the file lock
+        generation = uuid.uuid4().hex
+        state = {"version": INDEX_VERSION, "generation": generation, "postings": self.postings, "lengths": self.lengths,
+                 "chunk_terms": self.chunk_terms, "fields": self.fields, "chunk_fields": self.chunk_fields, "total_length": self.total_length}
+        # write then rename, readers never see half an index; the snapshot first, a journal
+        # of an older generation next to it is ignored
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.path)
+        temporary = f"{self.journal_path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump({"generation": generation}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            offset = f.tell()
+        os.replace(temporary, self.journal_path)
+        self.generation, self.journal_inode, self.journal_offset = generation, os.stat(self.journal_path).st_ino, offset
+        self.pending = []
+
+
+    def _remove(self, id: str) -> None:
+        for term in self.chunk_terms.pop(id, ()):
+            postings = self.postings[term]
+            del postings[id]
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(id, 0)
+        self._set_fields(id, None)
+
+
+    def _set_fields(self, id: str, metadata) -> None:
+        for field, value in self.chunk_fields.pop(id, {}).items():
+            chunks = self.fields[field][value]
+            chunks.discard(id)
+            if not chunks:
+                del self.fields[field][value]
+        if metadata is None:
+            return
+        values = {field: metadata[field] for field in FILTER_FIELDS if metadata.get(field) is not None}
+        for field, value in values.items():
+            self.fields[field].setdefault(value, set()).add(id)
+        self.chunk_fields[id] = values
+
+
+    def _apply(self, record: tuple) -> None:
+        # ("add", id, term frequencies, length, fields) | ("fields", id, fields) | ("remove", id)
+        operation, id = record[0], record[1]
+        if operation == "add":
+            # upsert, like the collection
+            self._remove(id)
+            frequencies, length, fields = record[2:]
+            for term, frequency in frequencies.items():
+                self.postings.setdefault(term, {})[id] = frequency
+            self.chunk_terms[id] = list(frequencies)
+            self.lengths[id] = length
+            self.total_length += length
+            self._set_fields(id, fields)
+        elif operation == "fields":
+            if id in self.lengths:
+                self._set_fields(id, record[2])
+        else:
+            self._remove(id)
+
+
+    def _record(self, record: tuple) -> None:
+        self._apply(record)
+        self.pending.append(record)
+
+
+    def add(self, ids: list, texts: list, metadatas: list) -> None:
+        with self.lock:
+            for id, text, metadata in zip(ids, texts, metadatas):
+                frequencies = {}
+                tokens = tokenize(text)
+                for token in tokens:
+                    frequencies[token] = frequencies.get(token, 0) + 1
+                fields = {field: value for field, value in (metadata or {}).items() if field in FILTER_FIELDS}
+                self._record(("add", id, frequencies, len(tokens), fields))
+
+
+    def update(self, ids: list, metadatas: list) -> None:
+        # the text is unchanged, only what the chunk can be filtered by
+        with self.lock:
+            for id, metadata in zip(ids, metadatas):
+                if id in self.lengths:
+                    self._record(("fields", id, {field: value for field, value in (metadata or {}).items() if field in FILTER_FIELDS}))
+
+
+    def remove(self, ids: list) -> None:
+        with self.lock:
+            for id in ids:
+                self._record(("remove", id))
+
+
+    def remove_document(self, doc_name: str) -> None:
+        with self.lock:
+            for id in list(self.fields["doc_name"].get(doc_name, ())):
+                self._record(("remove", id))
+
+
+    def filter_ids(self, where: dict):
+        """
+        Chunk ids matching a where filter of equality / $in conditions on FILTER_FIELDS, combined with $and.
+        """
+        if "$and" in where:
+            selected = None
+            for clause in where["$and"]:
+                ids = self.filter_ids(clause)
+                selected = ids if selected is None else selected & ids
+            return selected if selected is not None else set(self.lengths)
+
+        selected = None
+        for field, condition in where.items():
+            if field not in self.fields:
+                raise ValueError(f"bm25 searches can only be filtered by {', '.join(FILTER_FIELDS)}")
+            values = condition.get("$in", [condition.get("$eq")]) if isinstance(condition, dict) else [condition]
+            ids = set().union(*(self.fields[field].get(value, set()) for value in values))
+            selected = ids if selected is None else selected & ids
+        return selected if selected is not None else set(self.lengths)
+
+
+    def search(self, query: str, n_results: int = 10, where: dict = None) -> list:
+        """
+        Returns (chunk id, score) of the best n_results chunks, best first. where restricts the search, see filter_ids.
+        """
+        self.reload_if_changed()
+        with self.lock:
+            count = len(self.lengths)
+            if not count:
+                return []
+            ids = self.filter_ids(where) if where else None
+            if ids is not None and not ids:
+                return []
+            average_length = self.total_length / count
+            scores = {}
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                # walk whichever is shorter, the postings or the chunks in scope
+                if ids is None:
+                    candidates = postings.items()
+                elif len(ids) < len(postings):
+                    candidates = ((id, postings[id]) for id in ids if id in postings)
+                else:
+                    candidates = ((id, frequency) for id, frequency in postings.items() if id in ids)
+                for id, frequency in candidates:
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[id] / average_length)
+                    scores[id] = scores.get(id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"chunks": len(self.lengths), "documents": len(self.fields["doc_name"]), "terms": len(self.postings)}
+
+
+    def field_values(self) -> dict:
+        # field -> {value: number of chunks}, e.g. the documents and categories that can be searched
+        self.reload_if_changed()
+        with self.lock:
+            return {field: {value: len(ids) for value, ids in values.items()} for field, values in self.fields.items()}
+
+
+_bm25_index = None
+
+def get_bm25_index() -> BM25Index:
+    global _bm25_index
+    if _bm25_index is None:
+        _bm25_index = BM25Index()
+    return _bm25_index
+
+
+async def rebuild(batch_size: int = 1000) -> None:
+    # builds the index from everything in the chroma collection, for chunks stored before the index existed
+    from Rag.vector_db import get_vector_db
+
+    vector_db = get_vector_db()
+    await vector_db.ensure_connected()
+    index = get_bm25_index()
+    with index.lock:
+        index._reset()
+        index.pending = []
+    offset = 0
+    while True:
+        batch = await vector_db.collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+        if not batch["ids"]:
+            break
+        index.add(batch["ids"], batch["documents"], batch["metadatas"])
+        offset += len(batch["ids"])
+        print(f"indexed {offset} chunks")
+    with index.lock, index.file_lock:
+        index._compact()
+    print("bm25 index:", index.stats())
+
+
+if __name__ == "__main__":
+    # python -m Rag.bm25 rebuild
+    if sys.argv[1:] == ["rebuild"]:
+        asyncio.run(rebuild())
+    else:
+        print("bm25 index:", get_bm25_index().stats())
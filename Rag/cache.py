@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "cache/llm_cache.sqlite3")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+
+def cache_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class DiskLRUCache:
+    """
+    Persistent string cache in a sqlite file, bounded by the total size of the stored values.
+    The least recently used entries are evicted first. Hit and miss counters are stored
+    alongside the entries so they survive restarts and are shared between processes.
+    """
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('bytes', 0)")
+
+
+    def _increment(self, name: str, amount: int) -> None:
+        self.conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (amount, name))
+
+
+    def get(self, key: str):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self._increment("misses", 1)
+                else:
+                    self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self._increment("hits", 1)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        return row[0] if row else None
+
+
+    def set(self, key: str, value: str) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+                self._increment("bytes", size - (old[0] if old else 0))
+                self._evict()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+
+    def _evict(self) -> None:
+        total = self.conn.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM entries ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._increment("bytes", -size)
+                total -= size
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = dict(self.conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": counters["bytes"],
+            "max_bytes": self.max_bytes,
+            "hits": counters["hits"],
+            "misses": counters["misses"],
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+        }
+
+
+_llm_cache = None
+
+def get_llm_cache() -> DiskLRUCache:
+    # chunk headers and document summaries share one cache, the key says what a value is
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = DiskLRUCache(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES)
+    return _llm_cache
+
+
+if __name__ == "__main__":
+    # python -m Rag.cache [cache file ...]
+    for path in sys.argv[1:] or [LLM_CACHE_PATH]:
+        print(json.dumps(DiskLRUCache(path, LLM_CACHE_MAX_BYTES).stats(), indent=4))
@@ -1,6 +1,10 @@
 # from huggingface_hub import login
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_groq import ChatGroq
+from Rag.cache import cache_key, get_llm_cache
+from Rag.clients import get_client_registry
+from Rag.groq_keys import estimate_tokens, get_key_scheduler
+import json
 import os
 
 
@@ -9,34 +13,181 @@ HUGGINGFACE_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
 MAX_CONTENT_TOKENS = 4000
 TOKENIZER_MODEL_NAME =  os.getenv("TOKENIZER_MODEL_NAME")
 
-GROQ_MODEL_NAME = os.getenv("GROQ_MODEL_NAME")
+GROQ_MODEL_NAME = os.getenv("GROQ_MODEL_NAME", "llama3-8b-8192")
+
+# bump when SYSTEM or BATCH_SYSTEM change so cached headers are not reused
+HEADER_PROMPT_VERSION = 2
+
+# a title plus a ten word summary, with some slack
+HEADER_MAX_TOKENS = 100
+
+# batched mode: how many chunks go into one request and how many prompt tokens they may use
+CCH_BATCH_SIZE = int(os.getenv("CCH_BATCH_SIZE", 10))
+CCH_BATCH_TOKEN_BUDGET = int(os.getenv("CCH_BATCH_TOKEN_BUDGET", 6000))
 
 SYSTEM = '''
 You are given a chunk of text from a document named {doc_title}.
 Give an appropriate title to the chunk and a brief summary of it under 10 words to enhance vector embeddings.
-Your response MUST be the title and summary and nothing else. DO NOT respond with anything else.
+Your response MUST be exactly these two lines and nothing else. DO NOT respond with anything else:
+Title: <title>
+Summary: <summary>
 '''.strip()
 
 TRUNCATION_MESSAGE = "Also note that the document text provided below is just the first ~{num_words} words of the document. That should be plenty for this task. Your response should still pertain to the entire document, not just the text provided below."
 
 HUMAN = "{text}"
 
-def add_chunk_header(doc_title: str, content: str, GROQ_API_KEY: str):
+BATCH_SYSTEM = '''
+You are given numbered chunks of text from a document named {doc_title}.
+For every chunk give an appropriate title and a brief summary of it under 10 words to enhance vector embeddings.
+Your response MUST be a JSON array with exactly one object per chunk, in the same order, and nothing else:
+[{{"chunk": 1, "title": "...", "summary": "..."}}]
+'''.strip()
+
+BATCH_CHUNK = "CHUNK {number}:\n{text}"
+
+PROMPT = ChatPromptTemplate.from_messages([("system", SYSTEM), ("human", HUMAN)])
+BATCH_PROMPT = ChatPromptTemplate.from_messages([("system", BATCH_SYSTEM), ("human", HUMAN)])
+
+
+def get_chat(GROQ_API_KEY: str, max_tokens: int) -> ChatGroq:
+    # pooled per key by the client registry
+    return get_client_registry().chat(GROQ_API_KEY, GROQ_MODEL_NAME, max_tokens)
+
+
+def header_cache_key(doc_title: str, content: str) -> str:
+    return cache_key("chunk_header", GROQ_MODEL_NAME, HEADER_PROMPT_VERSION, doc_title, content)
+
+
+def header_block(header: str) -> str:
+    # the header's lines, then a blank line before the chunk text, whatever spacing the model used
+    return "\n".join(line.strip() for line in header.strip().splitlines() if line.strip()) + "\n\n"
+
+
+def cached_chunk_header(doc_title: str, content: str):
+    header = get_llm_cache().get(header_cache_key(doc_title, content))
+    return header_block(header) if header is not None else None
+
+
+async def add_chunk_header(doc_title: str, content: str):
     # login(HUGGINGFACE_TOKEN)
 
     # tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_MODEL_NAME)
     # tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-3.1-8B")
 
-    chat = ChatGroq(temperature=0, groq_api_key=GROQ_API_KEY, model_name=GROQ_MODEL_NAME, max_tokens=MAX_CONTENT_TOKENS, max_retries=2)
-
-    # system_message = truncate_content(content=content, max_tokens=MAX_CONTENT_TOKENS)
+    header = cached_chunk_header(doc_title, content)
+    if header is None:
+        header = await generate_chunk_header(doc_title, content)
+    return header + content
 
-    prompt = ChatPromptTemplate.from_messages([("system", SYSTEM), ("human", HUMAN)])
 
+async def generate_chunk_header(doc_title: str, content: str) -> str:
+    # system_message = truncate_content(content=content, max_tokens=MAX_CONTENT_TOKENS)
 
-    chain = prompt | chat
-    response = chain.invoke({"doc_title": doc_title, "text": content})
-    return response.content + content
+    # on the async client: waiting for key capacity or the response holds no thread
+    def call(GROQ_API_KEY):
+        chain = PROMPT | get_chat(GROQ_API_KEY, HEADER_MAX_TOKENS)
+        return chain.ainvoke({"doc_title": doc_title, "text": content})
+
+    response = await get_key_scheduler().arun(call, estimate_tokens(SYSTEM, doc_title, content, max_tokens=HEADER_MAX_TOKENS))
+    header = header_block(response.content)
+    get_llm_cache().set(header_cache_key(doc_title, content), header)
+    return header
+
+
+class ChunkBatcher:
+    """
+    Packs chunks into batches of at most batch_size chunks whose estimated prompt tokens
+    stay within token_budget, as they are produced. A chunk larger than the budget gets a batch of its own.
+    """
+
+    def __init__(self, batch_size: int = CCH_BATCH_SIZE, token_budget: int = CCH_BATCH_TOKEN_BUDGET) -> None:
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.batch, self.batch_tokens = [], 0
+
+
+    def add(self, item, text: str) -> list:
+        # returns the batches completed by adding this chunk, in order
+        full = []
+        tokens = estimate_tokens(text)
+        if self.batch and self.batch_tokens + tokens > self.token_budget:
+            full.append(self.flush())
+        self.batch.append(item)
+        self.batch_tokens += tokens
+        if len(self.batch) >= self.batch_size:
+            full.append(self.flush())
+        return full
+
+
+    def flush(self) -> list:
+        batch = self.batch
+        self.batch, self.batch_tokens = [], 0
+        return batch
+
+
+def pack_chunk_batches(chunks: list, batch_size: int = CCH_BATCH_SIZE, token_budget: int = CCH_BATCH_TOKEN_BUDGET) -> list:
+    # chunk indices grouped the way ChunkBatcher groups them
+    batcher = ChunkBatcher(batch_size, token_budget)
+    batches = []
+    for index, chunk in enumerate(chunks):
+        batches.extend(batcher.add(index, chunk))
+    last = batcher.flush()
+    return batches + [last] if last else batches
+
+
+def parse_chunk_headers(response: str, expected: int):
+    # the model sometimes wraps the array in prose or a code fence, only the outermost array matters
+    start, end = response.find("["), response.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        items = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+
+    if not isinstance(items, list) or len(items) != expected:
+        return None
+
+    headers = []
+    for number, item in enumerate(items, start=1):
+        # a dropped or reordered item would put every later header on the wrong chunk
+        if not isinstance(item, dict) or item.get("chunk") != number or not item.get("title") or not item.get("summary"):
+            return None
+        # one line each, a line break inside a value would break the header format context.split_header reads
+        title, summary = (" ".join(str(item[field]).split()) for field in ("title", "summary"))
+        headers.append(f"Title: {title}\nSummary: {summary}\n\n")
+    return headers
+
+
+async def add_chunk_headers(doc_title: str, contents: list) -> list:
+    """
+    Batched add_chunk_header: one request returns a title and summary for every chunk in contents.
+    Falls back to one request per chunk when the response can't be parsed.
+    Callers are expected to have looked up cached headers already.
+    """
+    if len(contents) == 1:
+        return [await generate_chunk_header(doc_title, contents[0]) + contents[0]]
+
+    text = "\n\n".join(BATCH_CHUNK.format(number=number, text=content) for number, content in enumerate(contents, start=1))
+    max_tokens = HEADER_MAX_TOKENS * len(contents)
+
+    def call(GROQ_API_KEY):
+        chain = BATCH_PROMPT | get_chat(GROQ_API_KEY, max_tokens)
+        return chain.ainvoke({"doc_title": doc_title, "text": text})
+
+    response = await get_key_scheduler().arun(call, estimate_tokens(BATCH_SYSTEM, doc_title, text, max_tokens=max_tokens))
+
+    headers = parse_chunk_headers(response.content, expected=len(contents))
+    if headers is None:
+        print(f"could not parse batched chunk headers, falling back to {len(contents)} single requests")
+        return [await generate_chunk_header(doc_title, content) + content for content in contents]
+
+    cache = get_llm_cache()
+    for header, content in zip(headers, contents):
+        cache.set(header_cache_key(doc_title, content), header)
+
+    return [header + content for header, content in zip(headers, contents)]
     
 # content = '''
 # SECURITIES REGISTERED PURSUANT TO SECTION 12(B) OF THE ACT:\nClass B Common Stock NKE New York Stock Exchange\n(Title of each class) (Trading symbol) (Name of each exchange on which registered)\nSECURITIES REGISTERED PURSUANT TO SECTION 12(G) OF THE ACT:\nNONE\nIndicate by check mark: Yes No\n•if the registrant is a well-known seasoned issuer, as defined in Rule 405 of the Securities Act. þ ¨\n•if the registrant is not required to file reports pursuant to Section 13 or Section 15(d) of the Act. ¨ þ\n•whether the registrant (1) has filed all reports required to be filed by Section 13 or 15(d) of the Securities \nExchange Act of 1934 during the preceding 12 months (or for such shorter period that the registrant was required \nto file such reports), and (2) has been subject to such filing requirements for the past 90 days.þ ¨\n•whether the registrant has submitted electronically every Interactive Data File required to be submitted pursuant to', '•whether the registrant has submitted electronically every Interactive Data File required to be submitted pursuant to \nRule 405 of Regulation S-T (§232.405 of this chapter) during the preceding 12 months (or for such shorter period \nthat the registrant was required to submit such files).þ ¨\n•whether the registrant is a large accelerated filer, an accelerated filer, a non-accelerated filer, a smaller reporting company or an emerging growth \ncompany. See the definitions of “large accelerated filer,” “accelerated filer,” “smaller reporting company,” and “emerging growth company” in Rule 12b-2 of \nthe Exchange Act.\nLarge accelerated filer þ Accelerated filer ☐ Non-accelerated filer ☐ Smaller reporting company ☐ Emerging growth company ☐\n•if an emerging growth company, if the registrant has elected not to use the extended transition period for \ncomplying with any new or revised financial accounting standards provided pursuant to Section 13(a) of the \nExchange Act.¨
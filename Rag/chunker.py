@@ -0,0 +1,148 @@
+import os
+import re
+from collections import deque
+
+
+# chunks are sized in tokens of the embedding model, 250/50 is about the old 1000/200 characters
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 250))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 50))
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "sentence-transformers/all-MiniLM-L6-v2")
+
+# a chunk may end early on a sentence or line break, but not before this share of CHUNK_TOKENS
+MIN_CHUNK_FILL = 0.8
+
+SENTENCE_ENDS = {".", "!", "?", ";", ":"}
+FALLBACK_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def regex_token_offsets(text: str) -> list:
+    return [match.span() for match in FALLBACK_TOKEN.finditer(text)]
+
+
+_token_offsets = None
+
+def get_token_offsets():
+    """
+    Returns a function text -> [(start, end), ...] of token character offsets.
+    Uses the embedding model's tokenizer when it can be loaded, otherwise a word/punctuation regex.
+    """
+    global _token_offsets
+    if _token_offsets is None:
+        try:
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_pretrained(CHUNK_TOKENIZER)
+            tokenizer.no_truncation()
+
+            def hf_token_offsets(text: str) -> list:
+                return [span for span in tokenizer.encode(text, add_special_tokens=False).offsets if span[1] > span[0]]
+
+            _token_offsets = hf_token_offsets
+        except Exception as e:
+            print(f"could not load tokenizer {CHUNK_TOKENIZER} ({e}), counting regex tokens instead")
+            _token_offsets = regex_token_offsets
+    return _token_offsets
+
+
+def count_tokens(text: str) -> int:
+    return len(get_token_offsets()(text))
+
+
+class StreamingChunker:
+    """
+    Splits a document into overlapping chunks of at most chunk_tokens tokens while its pages
+    are still arriving. Pages are joined with "\\n" exactly like extract_text joins them, and
+    chunks carry the pages they span.
+
+    Where a chunk ends depends only on the next chunk_tokens tokens, so feeding pages one by
+    one gives the same chunks as feeding the whole document and calling finish().
+    """
+
+    def __init__(self, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS, token_offsets=None) -> None:
+        if not 0 <= overlap_tokens < chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.token_offsets = token_offsets or get_token_offsets()
+
+        # document text from text_offset on, and the not yet dropped tokens as (start, end, page)
+        self.text = ""
+        self.text_offset = 0
+        self.length = 0
+        self.tokens = deque()
+        # tokens[0] is token number first_token of the document, emitted_until is one past the last emitted token
+        self.first_token = 0
+        self.emitted_until = 0
+        self.chunk_index = 0
+
+
+    def add_page(self, page_number: int, text: str) -> list:
+        page_text = text + "\n"
+        base = self.length
+        self.text += page_text
+        self.length += len(page_text)
+        self.tokens.extend((base + start, base + end, page_number) for start, end in self.token_offsets(page_text))
+        return self._drain()
+
+
+    def finish(self) -> list:
+        chunks = self._drain()
+        if self.first_token + len(self.tokens) > self.emitted_until:
+            chunks.append(self._emit(len(self.tokens)))
+        self.tokens.clear()
+        return chunks
+
+
+    def _is_break(self, i: int) -> bool:
+        # ending after token i is good if it closes a sentence or the next token starts a new line
+        start, end, _ = self.tokens[i]
+        if self.text[start - self.text_offset:end - self.text_offset] in SENTENCE_ENDS:
+            return True
+        return "\n" in self.text[end - self.text_offset:self.tokens[i + 1][0] - self.text_offset]
+
+
+    def _chunk_length(self) -> int:
+        # only tokens[:chunk_tokens] are looked at, more tokens arriving later can't change the result
+        for i in range(self.chunk_tokens - 2, int(self.chunk_tokens * MIN_CHUNK_FILL) - 2, -1):
+            if self._is_break(i):
+                return i + 1
+        return self.chunk_tokens
+
+
+    def _emit(self, length: int) -> dict:
+        first, last = self.tokens[0], self.tokens[length - 1]
+        chunk = {
+            "text": self.text[first[0] - self.text_offset:last[1] - self.text_offset],
+            "chunk_index": self.chunk_index,
+            "page_start": first[2],
+            "page_end": last[2],
+            "tokens": length,
+        }
+        self.chunk_index += 1
+        self.emitted_until = self.first_token + length
+        return chunk
+
+
+    def _drain(self) -> list:
+        chunks = []
+        while len(self.tokens) >= self.chunk_tokens:
+            length = self._chunk_length()
+            chunks.append(self._emit(length))
+
+            for _ in range(max(1, length - self.overlap_tokens)):
+                self.tokens.popleft()
+                self.first_token += 1
+
+            # text before the first kept token is never needed again
+            cut = self.tokens[0][0] - self.text_offset if self.tokens else len(self.text)
+            self.text = self.text[cut:]
+            self.text_offset += cut
+        return chunks
+
+
+def split_pages(pages, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+    # generator over chunks of an iterable of (page_number, text)
+    chunker = StreamingChunker(chunk_tokens, overlap_tokens)
+    for page_number, text in pages:
+        yield from chunker.add_page(page_number, text)
+    yield from chunker.finish()
@@ -0,0 +1,141 @@
+import os
+import threading
+from groq import AsyncGroq, Groq
+import httpx
+from langchain_groq import ChatGroq
+from Rag.groq_keys import get_key_scheduler
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# the groq SDK reads GROQ_BASE_URL, langchain's ChatGroq GROQ_API_BASE; either points every client elsewhere
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL") or os.getenv("GROQ_API_BASE") or None
+WHISPER_BASE_URL = os.getenv("WHISPER_BASE_URL", "https://api.groq.com/openai/v1")
+# seconds; the read timeout also bounds the gap between two streamed chunks
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 60))
+LLM_WRITE_TIMEOUT = float(os.getenv("LLM_WRITE_TIMEOUT", 30))
+# connections per API key and client flavour, the idle ones are kept alive for reuse
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 50))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+
+
+def llm_timeout() -> httpx.Timeout:
+    return httpx.Timeout(connect=LLM_CONNECT_TIMEOUT, read=LLM_READ_TIMEOUT, write=LLM_WRITE_TIMEOUT, pool=LLM_CONNECT_TIMEOUT)
+
+
+def llm_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+
+
+def header_hooks(api_key: str, asynchronous: bool) -> dict:
+    # every response's x-ratelimit-* headers go to the key scheduler, whichever SDK made the call
+    def observe(response):
+        get_key_scheduler().observe_headers(api_key, response.headers)
+
+    async def observe_async(response):
+        observe(response)
+
+    return {"response": [observe_async if asynchronous else observe]}
+
+
+class ClientRegistry:
+    """
+    The LLM clients of the process, created once per API key and kept for its lifetime. Each key
+    gets one sync and one async httpx pool with keep-alive connections, shared by its Groq,
+    AsyncGroq and ChatGroq clients, so requests reuse open TLS connections; the pools hand every
+    response's rate-limit headers to the key scheduler. The Whisper
+    transcription client (OpenAI SDK against Groq's OpenAI-compatible endpoint) has its own pool.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sync_clients = {}
+        self.async_clients = {}
+        self.chats = {}
+        self.openai_clients = {}
+
+
+    def groq(self, api_key: str) -> Groq:
+        with self.lock:
+            client = self.sync_clients.get(api_key)
+            if client is None:
+                client = Groq(api_key=api_key, base_url=GROQ_BASE_URL, timeout=llm_timeout(),
+                              http_client=httpx.Client(timeout=llm_timeout(), limits=llm_limits(), event_hooks=header_hooks(api_key, False)))
+                self.sync_clients[api_key] = client
+            return client
+
+
+    def async_groq(self, api_key: str) -> AsyncGroq:
+        with self.lock:
+            client = self.async_clients.get(api_key)
+            if client is None:
+                client = AsyncGroq(api_key=api_key, base_url=GROQ_BASE_URL, timeout=llm_timeout(),
+                                   http_client=httpx.AsyncClient(timeout=llm_timeout(), limits=llm_limits(), event_hooks=header_hooks(api_key, True)))
+                self.async_clients[api_key] = client
+            return client
+
+
+    def chat(self, api_key: str, model_name: str, max_tokens: int, temperature: float = 0) -> ChatGroq:
+        settings = (api_key, model_name, max_tokens, temperature)
+        with self.lock:
+            chat = self.chats.get(settings)
+        if chat is None:
+            # 429s are retried by the key scheduler on another key, not by the client on the same one
+            chat = ChatGroq(temperature=temperature, groq_api_key=api_key, model_name=model_name, max_tokens=max_tokens, max_retries=0,
+                            client=self.groq(api_key).with_options(max_retries=0).chat.completions,
+                            async_client=self.async_groq(api_key).with_options(max_retries=0).chat.completions)
+            with self.lock:
+                chat = self.chats.setdefault(settings, chat)
+        return chat
+
+
+    def openai(self, api_key: str, base_url: str = WHISPER_BASE_URL):
+        import openai
+
+        with self.lock:
+            client = self.openai_clients.get((api_key, base_url))
+            if client is None:
+                client = openai.OpenAI(api_key=api_key, base_url=base_url, timeout=llm_timeout(),
+                                       http_client=httpx.Client(timeout=llm_timeout(), limits=llm_limits()))
+                self.openai_clients[(api_key, base_url)] = client
+            return client
+
+
+    def start(self, api_keys: list) -> None:
+        # creates the clients up front, the first requests don't pay for it
+        for api_key in api_keys:
+            self.groq(api_key)
+            self.async_groq(api_key)
+
+
+    async def aclose(self) -> None:
+        with self.lock:
+            sync_clients = list(self.sync_clients.values()) + list(self.openai_clients.values())
+            async_clients = list(self.async_clients.values())
+            self.sync_clients, self.async_clients, self.chats, self.openai_clients = {}, {}, {}, {}
+        for client in sync_clients:
+            client.close()
+        for client in async_clients:
+            await client.close()
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "groq_clients": len(self.sync_clients),
+                "async_groq_clients": len(self.async_clients),
+                "chat_models": len(self.chats),
+                "openai_clients": len(self.openai_clients),
+            }
+
+
+_registry = None
+
+def get_client_registry() -> ClientRegistry:
+    global _registry
+    if _registry is None:
+        _registry = ClientRegistry()
+    return _registry
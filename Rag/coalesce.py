@@ -0,0 +1,279 @@
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+from contextlib import aclosing
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# without REDIS_URL identical requests are only coalesced within the process
+REDIS_URL = os.getenv("REDIS_URL")
+FLIGHT_PREFIX = "rag:flight:"
+# lease of the worker computing an answer, renewed by a heartbeat while it computes; when it runs
+# out without an end frame the computing worker is taken to be gone
+FLIGHT_LOCK_TTL = float(os.getenv("FLIGHT_LOCK_TTL", 60))
+# how long a finished flight's frames stay readable for workers that are still catching up
+FLIGHT_STREAM_TTL = float(os.getenv("FLIGHT_STREAM_TTL", 30))
+FLIGHT_POLL_SECONDS = float(os.getenv("FLIGHT_POLL_SECONDS", 1))
+FLIGHT_STREAM_MAXLEN = int(os.getenv("FLIGHT_STREAM_MAXLEN", 10000))
+
+# deletes the lock only while it still belongs to the worker releasing it
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# renews the lock, and the flight's stream with it, only while the lock belongs to the worker renewing it
+EXTEND_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[2], ARGV[3])
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def flight_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def encode_frame(frame) -> str:
+    return json.dumps({"message": frame} if isinstance(frame, dict) else {"token": frame})
+
+
+class Flight:
+    def __init__(self) -> None:
+        self.frames = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        # set when this worker computes the flight for the others too
+        self.leading = False
+        # replaced by a new event every time a frame arrives
+        self.updated = asyncio.Event()
+
+
+    def publish(self, frame) -> None:
+        self.frames.append(frame)
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests: the first request for a key starts the computation,
+    every request for the same key arriving while it runs gets the frames produced so far and then
+    the rest as they come. The computation runs in its own task, so it doesn't depend on the
+    first requester staying; it is cancelled once no one is listening any more.
+
+    With REDIS_URL set this also holds across workers. The worker that takes the key's lock in
+    Redis computes and appends every frame to a Redis stream of its own, named after its lock
+    token, the other workers read that stream instead of computing; if the lock expires without
+    an end frame they compute themselves. A worker computing for others runs to the end even when
+    its own requesters leave, other workers may still be reading.
+    """
+
+    def __init__(self, redis_url: str = REDIS_URL) -> None:
+        self.redis_url = redis_url
+        self.redis = None
+        self.flights = {}
+        self.counters = {"computed": 0, "joined_in_process": 0, "joined_across_workers": 0, "taken_over": 0}
+
+
+    def get_redis(self):
+        if self.redis is None and self.redis_url:
+            from redis import asyncio as aioredis
+
+            self.redis = aioredis.from_url(self.redis_url, decode_responses=True)
+        return self.redis
+
+
+    async def stream(self, key: str, factory):
+        """
+        Async generator over the frames of factory(), an async generator function, shared with
+        every other caller of the same key while it runs. The joiners' {"type": "done"} message
+        gets "coalesced": True.
+        """
+        flight = self.flights.get(key)
+        joined = flight is not None
+        if not joined:
+            flight = Flight()
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, factory))
+        else:
+            self.counters["joined_in_process"] += 1
+        flight.subscribers += 1
+
+        index = 0
+        try:
+            while True:
+                if index < len(flight.frames):
+                    frame = flight.frames[index]
+                    index += 1
+                    if joined and isinstance(frame, dict) and frame.get("type") == "done":
+                        frame = {**frame, "coalesced": True}
+                    yield frame
+                elif flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await flight.updated.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.finished and not flight.leading:
+                # nobody is listening, a later request for the key starts over
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.task.cancel()
+
+
+    async def _run(self, key: str, flight: Flight, factory) -> None:
+        try:
+            source = self._source(key, flight, factory)
+            async with aclosing(source):
+                async for frame in source:
+                    flight.publish(frame)
+        except asyncio.CancelledError:
+            flight.error = RuntimeError("the answer was cancelled")
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.finished = True
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            flight.updated.set()
+
+
+    async def _source(self, key: str, flight: Flight, factory):
+        redis = self.get_redis()
+        if redis is None:
+            self.counters["computed"] += 1
+            frames = factory()
+            async with aclosing(frames):
+                async for frame in frames:
+                    yield frame
+            return
+
+        lock = f"{FLIGHT_PREFIX}{key}:lock"
+        token = uuid.uuid4().hex
+        if not await redis.set(lock, token, nx=True, px=int(FLIGHT_LOCK_TTL * 1000)):
+            yielded = False
+            async for frame in self._follow(redis, key, lock):
+                yielded = True
+                yield frame
+            if yielded:
+                return
+            # the lock went away without anything written: the computing worker is gone
+            self.counters["taken_over"] += 1
+            if not await redis.set(lock, token, nx=True, px=int(FLIGHT_LOCK_TTL * 1000)):
+                async for frame in self._follow(redis, key, lock):
+                    yield frame
+                return
+
+        self.counters["computed"] += 1
+        flight.leading = True
+        async for frame in self._lead(redis, lock, f"{FLIGHT_PREFIX}{key}:frames:{token}", token, factory):
+            yield frame
+
+
+    async def _lead(self, redis, lock: str, stream: str, token: str, factory):
+        heartbeat = asyncio.create_task(self._heartbeat(redis, lock, stream, token))
+        expiring = False
+        try:
+            frames = factory()
+            async with aclosing(frames):
+                async for frame in frames:
+                    await redis.xadd(stream, {"frame": encode_frame(frame)}, maxlen=FLIGHT_STREAM_MAXLEN, approximate=True)
+                    if not expiring:
+                        # the stream outlives a worker that dies without releasing, but not forever
+                        await redis.pexpire(stream, int((FLIGHT_LOCK_TTL + FLIGHT_STREAM_TTL) * 1000))
+                        expiring = True
+                    yield frame
+            await redis.xadd(stream, {"frame": json.dumps({"end": True})})
+        except BaseException as e:
+            # the other workers fail the same way instead of waiting for the lock to run out
+            await asyncio.shield(redis.xadd(stream, {"frame": json.dumps({"error": str(e) or type(e).__name__})}))
+            raise
+        finally:
+            heartbeat.cancel()
+            await asyncio.shield(self._release(redis, lock, stream, token))
+
+
+    async def _heartbeat(self, redis, lock: str, stream: str, token: str) -> None:
+        # keeps the lock for as long as the flight runs, however long the model takes for a frame
+        while True:
+            await asyncio.sleep(FLIGHT_LOCK_TTL / 3)
+            try:
+                renewed = await redis.eval(EXTEND_LOCK, 2, lock, stream, token, int(FLIGHT_LOCK_TTL * 1000),
+                                           int((FLIGHT_LOCK_TTL + FLIGHT_STREAM_TTL) * 1000))
+            except Exception as e:
+                print(f"renewing flight lock {lock} failed: {e}")
+                continue
+            if not renewed:
+                # another worker took over, it computes into its own stream
+                print(f"flight lock {lock} was lost")
+                return
+
+
+    async def _release(self, redis, lock: str, stream: str, token: str) -> None:
+        await redis.expire(stream, int(FLIGHT_STREAM_TTL))
+        await redis.eval(RELEASE_LOCK, 1, lock, token)
+
+
+    async def _follow(self, redis, key: str, lock: str):
+        # the frames the worker holding the lock writes for the key, until its end frame or until its lock is gone
+        token = await redis.get(lock)
+        if token is None:
+            return
+        stream = f"{FLIGHT_PREFIX}{key}:frames:{token}"
+        last_id = "0"
+        while True:
+            entries = await redis.xread({stream: last_id}, count=100, block=int(FLIGHT_POLL_SECONDS * 1000))
+            if not entries:
+                if await redis.get(lock) == token:
+                    continue
+                # one more read: the end frame is written before the lock is released
+                entries = await redis.xread({stream: last_id}, count=100)
+                if not entries:
+                    if last_id != "0":
+                        raise RuntimeError("the worker computing this answer went away")
+                    return
+            if last_id == "0":
+                self.counters["joined_across_workers"] += 1
+            for entry_id, fields in entries[0][1]:
+                last_id = entry_id
+                frame = json.loads(fields["frame"])
+                if "end" in frame:
+                    return
+                if "error" in frame:
+                    raise RuntimeError(frame["error"])
+                if "message" in frame:
+                    message = frame["message"]
+                    yield {**message, "coalesced": True} if message.get("type") == "done" else message
+                else:
+                    yield frame["token"]
+
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.flights), "redis": bool(self.redis_url), **self.counters}
+
+
+    async def close(self) -> None:
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+
+
+_single_flight = None
+
+def get_single_flight() -> SingleFlight:
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
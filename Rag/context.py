@@ -0,0 +1,159 @@
+import os
+import re
+from Rag.bm25 import tokenize
+from Rag.groq_keys import estimate_tokens
+
+
+# prompt tokens the retrieved passages may take for the most involved questions, and for the simplest
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+CONTEXT_MIN_TOKEN_BUDGET = int(os.getenv("CONTEXT_MIN_TOKEN_BUDGET", 500))
+# questions with this many content words or more get the whole budget, shorter ones proportionally less
+CONTEXT_FULL_BUDGET_WORDS = int(os.getenv("CONTEXT_FULL_BUDGET_WORDS", 20))
+# ranked candidates retrieved for the packer to choose from
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 8))
+# share of the shorter passage's word shingles found in an already packed one above which it is a duplicate
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", 0.8))
+# a passage is cut to fit the remaining budget, but not below this many tokens
+CONTEXT_MIN_PASSAGE_TOKENS = int(os.getenv("CONTEXT_MIN_PASSAGE_TOKENS", 80))
+
+# the title/summary lines add_chunk_headers puts in front of every chunk for the embeddings,
+# separated from the chunk text by a blank line
+HEADER_LINE = re.compile(r"^(Title|Summary):(.*)$")
+SENTENCE_END = re.compile(r"[.!?;:]\s")
+
+
+def context_budget(query: str, available: int) -> int:
+    """
+    Tokens for the passages of this question: more content words, more evidence, within
+    CONTEXT_MIN_TOKEN_BUDGET..CONTEXT_TOKEN_BUDGET and never more than the model has available.
+    """
+    share = min(1.0, len(set(tokenize(query))) / CONTEXT_FULL_BUDGET_WORDS)
+    budget = CONTEXT_MIN_TOKEN_BUDGET + share * (CONTEXT_TOKEN_BUDGET - CONTEXT_MIN_TOKEN_BUDGET)
+    return max(0, min(int(budget), available))
+
+
+def split_header(document: str):
+    # (title, body) of a stored chunk, title None when it has no header; only the lines before the
+    # first blank line can be the header, and only when all of them are header lines
+    header, separator, body = document.strip().partition("\n\n")
+    matches = [HEADER_LINE.match(line.strip()) for line in header.split("\n")]
+    if not separator or not all(matches):
+        return None, document.strip()
+    title = next((value.strip() for field, value in (match.groups() for match in matches) if field == "Title"), None)
+    return title, body.strip()
+
+
+def shingles(text: str, size: int = 3) -> set:
+    words = tokenize(text)
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def is_duplicate(candidate: set, packed: list, threshold: float) -> bool:
+    # containment rather than jaccard: a chunk repeated inside a longer one is a duplicate too
+    return any(candidate and other and len(candidate & other) / min(len(candidate), len(other)) >= threshold for other in packed)
+
+
+def cut_to_tokens(text: str, tokens: int) -> str:
+    # the longest prefix within tokens, ending at a sentence end when there is one in its second half
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    prefix = text[:limit]
+    ends = [match.end() for match in SENTENCE_END.finditer(prefix)]
+    if ends and ends[-1] > limit // 2:
+        return prefix[:ends[-1]].rstrip()
+    return prefix[:prefix.rfind(" ")].rstrip() + " ..." if " " in prefix else prefix
+
+
+def source_line(number: int, metadata: dict, title: str) -> str:
+    line = f"[{number}] {metadata.get('doc_name') or 'unknown document'}"
+    if metadata.get("page") is not None:
+        line += f", page {metadata['page']}"
+    return f"{line}: {title}" if title else line
+
+
+def pack_context(ids: list, documents: list, metadatas: list, budget: int,
+                 duplicate_threshold: float = CONTEXT_DUPLICATE_THRESHOLD) -> dict:
+    """
+    Fills budget tokens with the ranked candidates, best first. Near-duplicates of a packed passage
+    are skipped, the embedding headers are reduced to a one-line source with the chunk title, and
+    a passage that doesn't fit is cut to the remaining budget when enough of it is left.
+    Returns {"context", "ids", "metadatas", "tokens", "budget", "duplicates", "over_budget"}.
+    """
+    passages, packed_ids, packed_metadatas, packed_shingles = [], [], [], []
+    used = duplicates = over_budget = 0
+
+    for id, document, metadata in zip(ids, documents, metadatas):
+        metadata = metadata or {}
+        title, body = split_header(document or "")
+        if not body:
+            continue
+        body_shingles = shingles(body)
+        if is_duplicate(body_shingles, packed_shingles, duplicate_threshold):
+            duplicates += 1
+            continue
+
+        header = source_line(len(passages) + 1, metadata, title)
+        # passages are separated by a blank line
+        tokens = estimate_tokens(header, body, "\n\n\n")
+        if used + tokens > budget:
+            room = budget - used - estimate_tokens(header, "\n\n\n")
+            if room < CONTEXT_MIN_PASSAGE_TOKENS and passages:
+                over_budget += 1
+                continue
+            body = cut_to_tokens(body, max(room, 0))
+            if not body:
+                over_budget += 1
+                continue
+            tokens = estimate_tokens(header, body, "\n\n\n")
+
+        passages.append(f"{header}\n{body}")
+        packed_ids.append(id)
+        packed_metadatas.append(metadata)
+        packed_shingles.append(body_shingles)
+        used += tokens
+
+    return {
+        "context": "\n\n".join(passages),
+        "ids": packed_ids,
+        "metadatas": packed_metadatas,
+        "tokens": used,
+        "budget": budget,
+        "duplicates": duplicates,
+        "over_budget": over_budget,
+    }
+
+
+class PackingStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.tokens = 0
+        self.budget = 0
+        self.passages = 0
+        self.duplicates = 0
+        self.over_budget = 0
+        self.empty = 0
+
+
+    def record(self, packed: dict) -> None:
+        self.count += 1
+        self.tokens += packed["tokens"]
+        self.budget += packed["budget"]
+        self.passages += len(packed["ids"])
+        self.duplicates += packed["duplicates"]
+        self.over_budget += packed["over_budget"]
+        self.empty += not packed["ids"]
+
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_tokens": round(self.tokens / self.count, 1) if self.count else None,
+            "mean_budget": round(self.budget / self.count, 1) if self.count else None,
+            "mean_passages": round(self.passages / self.count, 2) if self.count else None,
+            "duplicates_skipped": self.duplicates,
+            "over_budget_skipped": self.over_budget,
+            "empty": self.empty,
+        }
@@ -0,0 +1,335 @@
+import asyncio
+import os
+import re
+import threading
+import time
+import groq
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# per key limits of the plan the keys are on, the token limit is corrected from response headers
+GROQ_REQUESTS_PER_MINUTE = int(os.getenv("GROQ_REQUESTS_PER_MINUTE", 30))
+GROQ_TOKENS_PER_MINUTE = int(os.getenv("GROQ_TOKENS_PER_MINUTE", 6000))
+GROQ_RATE_LIMIT_RETRIES = int(os.getenv("GROQ_RATE_LIMIT_RETRIES", 5))
+# used when a 429 comes back without a retry-after header
+GROQ_DEFAULT_COOLDOWN = float(os.getenv("GROQ_DEFAULT_COOLDOWN", 10))
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value) -> float:
+    # groq sends resets like "7.66s", "2m59.56s" or "120ms"
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION_PART.findall(value))
+
+
+def estimate_tokens(*texts, max_tokens: int = 0) -> int:
+    # prompt tokens at ~4 characters each, plus the completion budget
+    return sum(len(text) for text in texts) // 4 + max_tokens
+
+
+def response_tokens(response):
+    # total tokens of a ChatGroq message or a groq completion, None when unknown; streamed groq
+    # completions report it in x_groq.usage of their last chunk, ChatGroq turns that into usage_metadata
+    usage_metadata = getattr(response, "usage_metadata", None)
+    if usage_metadata:
+        return usage_metadata.get("total_tokens")
+    usage = getattr(response, "usage", None) or getattr(getattr(response, "x_groq", None), "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def chunk_text(chunk) -> str:
+    # text of a streamed ChatGroq message chunk or groq completion chunk
+    content = getattr(chunk, "content", None)
+    if isinstance(content, str):
+        return content
+    choices = getattr(chunk, "choices", None)
+    return (choices[0].delta.content or "") if choices else ""
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, per_seconds: float = 60) -> None:
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.level = capacity
+        self.updated = time.monotonic()
+
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def wait_time(self, amount: float) -> float:
+        # a request bigger than the whole bucket waits for a full bucket and then goes into debt
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+
+class KeyState:
+    def __init__(self, key: str, requests_per_minute: int, tokens_per_minute: int) -> None:
+        self.key = key
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        # tokens reserved by the requests in flight, the server hasn't counted them yet
+        self.reserved = 0
+        # rate-limit headers of the latest response on this key, see observe_headers
+        self.observed_headers = None
+        self.rate_limited = 0
+        self.calls = 0
+
+
+    def headroom(self) -> float:
+        return min(self.requests.level / self.requests.capacity, self.tokens.level / self.tokens.capacity)
+
+
+class GroqKeyScheduler:
+    """
+    Hands out Groq API keys so that no key goes over its requests/min and tokens/min.
+    Every key has a token bucket for both, refilled continuously and corrected from the
+    x-ratelimit-* response headers. The least loaded key with capacity is picked, callers
+    wait when no key has capacity, and a key that gets a 429 is cooled down until its reset.
+    """
+
+    def __init__(self, keys: list, requests_per_minute: int = GROQ_REQUESTS_PER_MINUTE, tokens_per_minute: int = GROQ_TOKENS_PER_MINUTE) -> None:
+        if not keys:
+            raise ValueError("GroqKeyScheduler needs at least one API key")
+        self.states = {key: KeyState(key, requests_per_minute, tokens_per_minute) for key in keys}
+        self.condition = threading.Condition()
+        # (loop, event) of every acquire_async waiting for capacity, set on release like the condition
+        self.async_waiters = set()
+
+
+    def _try_acquire(self, estimated_tokens: int):
+        # returns (key, 0) when a key was reserved, otherwise (None, seconds until one may be free)
+        now = time.monotonic()
+        best, shortest_wait = None, None
+
+        for state in self.states.values():
+            state.requests.refill(now)
+            state.tokens.refill(now)
+            wait = max(state.cooldown_until - now, state.requests.wait_time(1), state.tokens.wait_time(estimated_tokens))
+            if wait > 0:
+                shortest_wait = wait if shortest_wait is None else min(shortest_wait, wait)
+            elif best is None or (state.headroom(), -state.in_flight) > (best.headroom(), -best.in_flight):
+                best = state
+
+        if best is None:
+            return None, shortest_wait
+
+        best.requests.level -= 1
+        best.tokens.level -= estimated_tokens
+        best.reserved += estimated_tokens
+        best.in_flight += 1
+        best.calls += 1
+        return best.key, 0.0
+
+
+    def acquire(self, estimated_tokens: int = 0) -> str:
+        with self.condition:
+            while True:
+                key, wait = self._try_acquire(estimated_tokens)
+                if key:
+                    return key
+                self.condition.wait(timeout=wait)
+
+
+    async def acquire_async(self, estimated_tokens: int = 0) -> str:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                key, wait = self._try_acquire(estimated_tokens)
+                if key:
+                    return key
+                waiter = (loop, asyncio.Event())
+                self.async_waiters.add(waiter)
+            try:
+                # a release, e.g. one giving back unused tokens, may free capacity before the refill would
+                await asyncio.wait_for(waiter[1].wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.condition:
+                    self.async_waiters.discard(waiter)
+
+
+    def _notify(self) -> None:
+        # called holding the condition
+        self.condition.notify_all()
+        for loop, event in self.async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # its loop is closed
+                pass
+
+
+    def _apply_headers(self, state: KeyState, headers, now: float) -> None:
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if limit_tokens and remaining_tokens:
+            state.tokens.refill(now)
+            state.tokens.capacity = float(limit_tokens)
+            state.tokens.rate = state.tokens.capacity / 60
+            # the server hasn't counted the reservations still in flight, and what this process knows
+            # it used is already in the level; the headers only lower it, e.g. for other processes' use
+            state.tokens.level = min(state.tokens.level, float(remaining_tokens) - state.reserved)
+
+        # the requests headers describe the daily quota, when it is used up the key sits out until the reset
+        if headers.get("x-ratelimit-remaining-requests") == "0":
+            state.cooldown_until = max(state.cooldown_until, now + parse_duration(headers.get("x-ratelimit-reset-requests")))
+
+
+    def observe_headers(self, key: str, headers) -> None:
+        # called for every response on a key's pooled clients (Rag.clients), applied on the next release
+        if "x-ratelimit-remaining-tokens" not in headers or key not in self.states:
+            return
+        with self.condition:
+            self.states[key].observed_headers = dict(headers)
+
+
+    def release(self, key: str, estimated_tokens: int = 0, used_tokens: int = None, headers=None) -> None:
+        with self.condition:
+            state = self.states[key]
+            now = time.monotonic()
+            state.in_flight -= 1
+            state.reserved -= estimated_tokens
+            if used_tokens is not None:
+                state.tokens.level += estimated_tokens - used_tokens
+            headers = headers or state.observed_headers
+            state.observed_headers = None
+            if headers:
+                self._apply_headers(state, headers, now)
+            self._notify()
+
+
+    def rate_limited(self, key: str, headers=None, estimated_tokens: int = 0) -> None:
+        with self.condition:
+            state = self.states[key]
+            now = time.monotonic()
+            state.in_flight -= 1
+            state.reserved -= estimated_tokens
+            state.rate_limited += 1
+            retry_after = parse_duration(headers.get("retry-after")) if headers else 0.0
+            state.cooldown_until = max(state.cooldown_until, now + (retry_after or GROQ_DEFAULT_COOLDOWN))
+            if headers:
+                self._apply_headers(state, headers, now)
+            self._notify()
+
+
+    def _finish(self, key: str, estimated_tokens: int, response) -> None:
+        # raw responses (with_raw_response) carry the rate-limit headers, parsed ones carry usage;
+        # the pooled clients' responses had their headers observed already
+        self.release(key, estimated_tokens, used_tokens=response_tokens(response), headers=getattr(response, "headers", None))
+
+
+    def run(self, call, estimated_tokens: int = 0):
+        """
+        Call call(key) with a key that has capacity, retrying on another key when it gets a 429.
+        """
+        for attempt in range(GROQ_RATE_LIMIT_RETRIES + 1):
+            key = self.acquire(estimated_tokens)
+            try:
+                response = call(key)
+            except groq.RateLimitError as e:
+                self.rate_limited(key, e.response.headers, estimated_tokens)
+                if attempt == GROQ_RATE_LIMIT_RETRIES:
+                    raise
+                continue
+            except Exception:
+                self.release(key, estimated_tokens)
+                raise
+            self._finish(key, estimated_tokens, response)
+            return response
+
+
+    async def arun(self, call, estimated_tokens: int = 0):
+        # same as run, for calls returning an awaitable
+        for attempt in range(GROQ_RATE_LIMIT_RETRIES + 1):
+            key = await self.acquire_async(estimated_tokens)
+            try:
+                response = await call(key)
+            except groq.RateLimitError as e:
+                self.rate_limited(key, e.response.headers, estimated_tokens)
+                if attempt == GROQ_RATE_LIMIT_RETRIES:
+                    raise
+                continue
+            except BaseException:
+                self.release(key, estimated_tokens)
+                raise
+            self._finish(key, estimated_tokens, response)
+            return response
+
+
+    async def astream(self, call, estimated_tokens: int = 0, prompt_tokens: int = None):
+        """
+        Async generator over call(key), an async iterator such as a streamed completion. A 429 before
+        the first item is retried on another key; once items were yielded the error is raised.
+        The unused part of the reservation is given back when the stream ends: the usage reported
+        with its last chunk, or else prompt_tokens plus an estimate of the streamed text.
+        """
+        for attempt in range(GROQ_RATE_LIMIT_RETRIES + 1):
+            key = await self.acquire_async(estimated_tokens)
+            items = call(key)
+            started = False
+            used_tokens, streamed_chars = None, 0
+
+            def used():
+                if used_tokens is not None:
+                    return used_tokens
+                return prompt_tokens + streamed_chars // 4 if prompt_tokens is not None else None
+
+            try:
+                async for item in items:
+                    started = True
+                    used_tokens = response_tokens(item) or used_tokens
+                    streamed_chars += len(chunk_text(item))
+                    yield item
+            except groq.RateLimitError as e:
+                self.rate_limited(key, e.response.headers, estimated_tokens)
+                if started or attempt == GROQ_RATE_LIMIT_RETRIES:
+                    raise
+                continue
+            except BaseException:
+                self.release(key, estimated_tokens, used_tokens=used())
+                raise
+            finally:
+                # when this generator is closed early the stream is closed now, not when it is collected
+                if hasattr(items, "aclose"):
+                    await items.aclose()
+            self.release(key, estimated_tokens, used_tokens=used())
+            return
+
+
+    def stats(self) -> dict:
+        with self.condition:
+            now = time.monotonic()
+            return {
+                key[-4:]: {
+                    "calls": state.calls,
+                    "in_flight": state.in_flight,
+                    "rate_limited": state.rate_limited,
+                    "tokens_available": round(state.tokens.level),
+                    "cooling_down_for": round(max(0.0, state.cooldown_until - now), 2),
+                }
+                for key, state in self.states.items()
+            }
+
+
+_scheduler = None
+
+def get_key_scheduler() -> GroqKeyScheduler:
+    # one scheduler per process, shared by every Groq call site
+    global _scheduler
+    if _scheduler is None:
+        keys = os.getenv("GROQ_API_KEYS_str") or os.getenv("GROQ_API_KEY", "")
+        _scheduler = GroqKeyScheduler([key.strip() for key in keys.split(",") if key.strip()])
+    return _scheduler
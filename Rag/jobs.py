@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+INGEST_JOBS_DB = os.getenv("INGEST_JOBS_DB", "cache/ingest_jobs.sqlite3")
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", 2))
+# a running job whose lease is not renewed for this many seconds is taken to be orphaned and runs again
+INGEST_JOB_LEASE = float(os.getenv("INGEST_JOB_LEASE", 60))
+# how often idle workers look for jobs submitted by other processes or released by a finished job
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", 2))
+
+PROGRESS_FIELDS = ("stage", "pages_done", "pages_total", "chunks_total", "chunks_embedded")
+
+
+class IngestionQueue:
+    """
+    Persistent queue of document ingestion jobs worked off by a pool of local asyncio workers.
+    Jobs live in a sqlite file shared by every worker process: a job is claimed atomically, at most one
+    job per file_name runs at a time, and a running job holds a lease its worker keeps renewing, so
+    jobs of a process that died are picked up again once the lease expires.
+    ingest is called as `await ingest(file_path=..., file_name=..., progress=...)` and may call
+    progress(stage=..., pages_done=..., ...) at any time, from any thread.
+    """
+
+    def __init__(self, ingest, db_path: str = INGEST_JOBS_DB, concurrency: int = INGEST_CONCURRENCY) -> None:
+        self.ingest = ingest
+        self.concurrency = max(1, concurrency)
+        self.lock = threading.Lock()
+        self.queue = asyncio.Queue()
+        self.workers = []
+        self.owner = str(uuid.uuid4())
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            options TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL,
+            stage TEXT,
+            pages_done INTEGER NOT NULL DEFAULT 0,
+            pages_total INTEGER,
+            chunks_total INTEGER,
+            chunks_embedded INTEGER NOT NULL DEFAULT 0,
+            stats TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            owner TEXT,
+            lease_until REAL,
+            updated_at REAL NOT NULL)""")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column in ("owner TEXT", "lease_until REAL"):
+            if column.split()[0] not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+        self.conn.commit()
+
+
+    def _update(self, job_id: str, **fields) -> bool:
+        # only the worker holding the job writes to it; False once the lease was lost to another worker
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock:
+            cursor = self.conn.execute(f"UPDATE jobs SET {columns} WHERE id = ? AND owner = ?", (*fields.values(), job_id, self.owner))
+            self.conn.commit()
+        return cursor.rowcount > 0
+
+
+    def _claim(self):
+        """ Mark the oldest runnable queued job as running under this queue's lease and return its id, or None. """
+        now = time.time()
+        with self.lock:
+            # running jobs whose worker stopped renewing the lease go back to the queue
+            self.conn.execute(
+                "UPDATE jobs SET status = 'queued', stage = 'queued', owner = NULL, lease_until = NULL, updated_at = ? WHERE status = 'running' AND lease_until < ?",
+                (now, now),
+            )
+            row = self.conn.execute(
+                """UPDATE jobs SET status = 'running', stage = 'starting', error = NULL, owner = ?, lease_until = ?, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs AS job WHERE status = 'queued'
+                    AND NOT EXISTS (SELECT 1 FROM jobs AS other WHERE other.file_name = job.file_name AND other.status = 'running')
+                    ORDER BY created_at LIMIT 1)
+                AND status = 'queued'
+                RETURNING id""",
+                (self.owner, now + INGEST_JOB_LEASE, now),
+            ).fetchone()
+            self.conn.commit()
+        return row[0] if row else None
+
+
+    async def _renew_lease(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(INGEST_JOB_LEASE / 3)
+            if not self._update(job_id, lease_until=time.time() + INGEST_JOB_LEASE):
+                return
+
+
+    def submit(self, file_path: str, file_name: str, **options) -> str:
+        # options are passed through to ingest as keyword arguments
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (id, file_path, file_name, options, status, stage, created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', 'queued', ?, ?)",
+                (job_id, file_path, file_name, json.dumps(options), now, now),
+            )
+            self.conn.commit()
+
+        self.queue.put_nowait(job_id)
+        return job_id
+
+
+    def get(self, job_id: str):
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+
+        if row is None:
+            return None
+
+        job = dict(zip(columns, row))
+        job["options"] = json.loads(job["options"])
+        job["stats"] = json.loads(job["stats"]) if job["stats"] else None
+        return job
+
+
+    def list(self, limit: int = 50) -> list:
+        with self.lock:
+            ids = [row[0] for row in self.conn.execute("SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))]
+        return [self.get(job_id) for job_id in ids]
+
+
+    async def _run(self, job_id: str) -> None:
+        job = self.get(job_id)
+        renewing = asyncio.create_task(self._renew_lease(job_id))
+
+        def progress(**fields):
+            self._update(job_id, **{name: value for name, value in fields.items() if name in PROGRESS_FIELDS})
+
+        try:
+            stats = await self.ingest(file_path=job["file_path"], file_name=job["file_name"], progress=progress, **job["options"])
+            self._update(job_id, status="done", stage="done", stats=json.dumps(stats), lease_until=None)
+        except asyncio.CancelledError:
+            # stopped mid-job: hand it back right away instead of waiting for the lease to run out
+            self._update(job_id, status="queued", stage="queued", owner=None, lease_until=None)
+            raise
+        except Exception as e:
+            print(f"ingestion job {job_id} failed: {e}")
+            self._update(job_id, status="failed", error=str(e), lease_until=None)
+        finally:
+            renewing.cancel()
+
+
+    async def _worker(self) -> None:
+        # the queue only wakes workers up, which job runs next is decided by _claim
+        while True:
+            job_id = self._claim()
+            if job_id is not None:
+                await self._run(job_id)
+                continue
+            try:
+                await asyncio.wait_for(self.queue.get(), timeout=INGEST_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+    def start(self) -> None:
+        # queued jobs, and running jobs whose lease expired, are picked up by _claim: ingestion is idempotent,
+        # and a document is only skipped as unchanged once an ingestion of it completed (model.ingestion_complete)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
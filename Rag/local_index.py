@@ -0,0 +1,535 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+from filelock import FileLock
+
+
+# rows the vector file starts with, it doubles when full
+INITIAL_CAPACITY = 1024
+
+# metadata fields with an index value -> rows, filters on them don't scan the collection
+INDEXED_FIELDS = ("doc_name", "category")
+
+# precision of the vectors a query scans: "float32", or "float16" / "int8" (with a scale per vector)
+# to take a half / a quarter of the memory; full-precision vectors stay on disk for re-scoring
+LOCAL_INDEX_PRECISION = os.getenv("LOCAL_INDEX_PRECISION", "float32")
+# a quantized scan keeps n_results * LOCAL_INDEX_RESCORE candidates for the full-precision re-scoring
+LOCAL_INDEX_RESCORE = int(os.getenv("LOCAL_INDEX_RESCORE", 4))
+PRECISIONS = ("float32", "float16", "int8")
+
+# rows converted to float32 at a time while scanning a quantized matrix
+SCAN_BLOCK_ROWS = 65536
+
+# entries of the change log other processes catch up from; one that fell further behind reloads everything
+LOCAL_INDEX_CHANGES_KEPT = int(os.getenv("LOCAL_INDEX_CHANGES_KEPT", 100000))
+
+
+def matches(metadata: dict, where) -> bool:
+    # the subset of chroma's where filters the app uses: equality, $eq, $ne, $in, $nin, $and, $or
+    if not where:
+        return True
+    if "$and" in where:
+        return all(matches(metadata, clause) for clause in where["$and"])
+    if "$or" in where:
+        return any(matches(metadata, clause) for clause in where["$or"])
+    for field, condition in where.items():
+        value = (metadata or {}).get(field)
+        if isinstance(condition, dict):
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+            if "$ne" in condition and value == condition["$ne"]:
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$nin" in condition and value in condition["$nin"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def quantize(vectors: np.ndarray, precision: str):
+    # (codes, scales), scales is None except for int8 where vector ~= codes * scale
+    if precision == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+
+def open_array(path: str, dtype, shape: tuple, old=None) -> np.ndarray:
+    # a memory-mapped .npy of shape, with the rows of old copied over when it replaces a smaller one
+    temporary = f"{path}.tmp"
+    array = np.lib.format.open_memmap(temporary, mode="w+", dtype=dtype, shape=shape)
+    if old is not None:
+        array[:len(old)] = old
+    array.flush()
+    del array
+    os.replace(temporary, path)
+    return np.lib.format.open_memmap(path, mode="r+")
+
+
+class LocalCollection:
+    """
+    Collection stored in the app's own process, with the async API of a chroma collection.
+    Vectors are normalized and kept in a memory-mapped float32 .npy file, one row per chunk;
+    ids, documents and metadatas are in a sqlite file next to it. Queries are an exact
+    (brute-force) cosine search over the mapped rows, distances are 1 - cosine similarity.
+    Filters on INDEXED_FIELDS pick their rows from an in-memory index before searching.
+
+    With precision "float16" or "int8" queries scan a quantized copy of the vectors instead and
+    re-score the best candidates with the float32 vectors, which are only paged in for those rows.
+
+    Several processes (e.g. uvicorn workers) can share a directory: every write holds an exclusive
+    file lock and first catches up with the others, and the ids each write touched go to a change
+    log in the sqlite file, from which the other processes reload just those rows on their next call.
+    """
+
+    def __init__(self, directory: str, name: str, precision: str = LOCAL_INDEX_PRECISION, rescore: int = LOCAL_INDEX_RESCORE) -> None:
+        if precision not in PRECISIONS:
+            raise ValueError(f"unknown precision {precision!r}, use one of {', '.join(PRECISIONS)}")
+        os.makedirs(directory, exist_ok=True)
+        self.precision = precision
+        self.rescore = rescore
+        self.vectors_path = os.path.join(directory, f"{name}.vectors.npy")
+        self.codes_path = os.path.join(directory, f"{name}.vectors.{precision}.npy")
+        self.scales_path = os.path.join(directory, f"{name}.scales.npy")
+        self.lock = threading.RLock()
+        # between processes, always taken after self.lock
+        self.file_lock = FileLock(os.path.join(directory, f"{name}.lock"))
+
+        self.conn = sqlite3.connect(os.path.join(directory, f"{name}.sqlite3"), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, slot INTEGER NOT NULL, document TEXT, metadata TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL)")
+        self.conn.commit()
+
+        self.vectors = None
+        self.vectors_inode = None
+        self.codes = None
+        self.scales = None
+        self._load()
+
+
+    def _load(self) -> None:
+        # the whole collection from disk; the change log position is read first, so a write
+        # committed while the records are read is applied again by the next _refresh
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.seen = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+        # id -> row of the vector file, and the other way round
+        self.slots = {}
+        self.ids = {}
+        self.documents = {}
+        self.metadatas = {}
+        self.field_slots = {field: {} for field in INDEXED_FIELDS}
+        for id, slot, document, metadata in self.conn.execute("SELECT id, slot, document, metadata FROM records"):
+            self._remember(id, slot, document, metadata)
+
+        self._open_vectors()
+        self._reset_rows()
+
+
+    def _open_vectors(self) -> None:
+        # maps the vector files, again after another process replaced them with bigger ones
+        if not os.path.exists(self.vectors_path):
+            return
+        self.vectors_inode = os.stat(self.vectors_path).st_ino
+        self.vectors = np.lib.format.open_memmap(self.vectors_path, mode="r+")
+        self.codes = None
+        self.scales = None
+        self._open_codes()
+
+
+    def _reset_rows(self) -> None:
+        capacity = len(self.vectors) if self.vectors is not None else 0
+        self.active = np.zeros(capacity, dtype=bool)
+        self.active[list(self.ids)] = True
+        self.free = sorted(set(range(capacity)) - set(self.ids), reverse=True)
+        self.high_water = max(self.ids) + 1 if self.ids else 0
+
+
+    def _remember(self, id: str, slot: int, document, metadata) -> None:
+        # a stored row, metadata as the json of the records table
+        if self.slots.get(id, slot) != slot:
+            self._forget(id)
+        if self.ids.get(slot, id) != id:
+            self._forget(self.ids[slot])
+        self.slots[id] = slot
+        self.ids[slot] = id
+        self.documents[slot] = document
+        self._set_metadata(slot, json.loads(metadata) if metadata else None)
+
+
+    def _forget(self, id: str) -> None:
+        slot = self.slots.pop(id, None)
+        if slot is None:
+            return
+        del self.ids[slot]
+        self.documents.pop(slot, None)
+        self._set_metadata(slot, None)
+
+
+    def _refresh(self) -> None:
+        # catches up with what other processes wrote, called holding self.lock
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.data_version:
+            return
+        self.data_version = version
+        first = self.conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        if first is not None and first > self.seen + 1:
+            # the changes this process missed are gone from the log
+            self._load()
+            return
+        changes = self.conn.execute("SELECT seq, id FROM changes WHERE seq > ? ORDER BY seq", (self.seen,)).fetchall()
+        if not changes:
+            return
+        self.seen = changes[-1][0]
+        ids = list(dict.fromkeys(id for _, id in changes))
+        found = {}
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            for row in self.conn.execute(f"SELECT id, slot, document, metadata FROM records WHERE id IN ({', '.join('?' * len(batch))})", batch):
+                found[row[0]] = row
+        # vectors are written before the rows referencing them are committed, so a file replaced
+        # for rows just read is in place by now
+        if os.path.exists(self.vectors_path) and os.stat(self.vectors_path).st_ino != self.vectors_inode:
+            self._open_vectors()
+        for id in ids:
+            if id in found:
+                self._remember(*found[id])
+            else:
+                self._forget(id)
+        self._reset_rows()
+
+
+    def _commit(self, ids) -> None:
+        # called holding the file lock; logs the ids this write touched for the other processes
+        self.conn.executemany("INSERT INTO changes (id) VALUES (?)", [(id,) for id in dict.fromkeys(ids)])
+        self.conn.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (LOCAL_INDEX_CHANGES_KEPT,))
+        self.conn.commit()
+        self.seen = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+
+    def _open_codes(self) -> None:
+        # the quantized copy of the vectors, rebuilt from them when missing or out of step
+        if self.precision == "float32":
+            return
+        shape = self.vectors.shape
+        if os.path.exists(self.codes_path):
+            self.codes = np.lib.format.open_memmap(self.codes_path, mode="r+")
+            if self.precision == "int8" and os.path.exists(self.scales_path):
+                self.scales = np.lib.format.open_memmap(self.scales_path, mode="r+")
+        if self.codes is not None and self.codes.shape == shape and (self.precision != "int8" or self.scales is not None and len(self.scales) == shape[0]):
+            return
+
+        print(f"building the {self.precision} copy of {self.vectors_path}")
+        self.codes = open_array(self.codes_path, np.float16 if self.precision == "float16" else np.int8, shape)
+        if self.precision == "int8":
+            self.scales = open_array(self.scales_path, np.float32, shape[:1])
+        for start in range(0, shape[0], SCAN_BLOCK_ROWS):
+            self._store_codes(slice(start, start + SCAN_BLOCK_ROWS), np.asarray(self.vectors[start:start + SCAN_BLOCK_ROWS]))
+        self._flush()
+
+
+    def _store_codes(self, rows, vectors: np.ndarray) -> None:
+        if self.codes is None:
+            return
+        codes, scales = quantize(vectors, self.precision)
+        self.codes[rows] = codes
+        if scales is not None:
+            self.scales[rows] = scales
+
+
+    def _store(self, slot: int, vector: np.ndarray) -> None:
+        self.vectors[slot] = vector
+        self._store_codes([slot], vector[None, :])
+
+
+    def _flush(self) -> None:
+        for array in (self.vectors, self.codes, self.scales):
+            if array is not None:
+                array.flush()
+
+
+    def _set_metadata(self, slot: int, metadata) -> None:
+        # keeps field_slots in step with the metadata of a row, None removes the row
+        for field, values in self.field_slots.items():
+            old = (self.metadatas.get(slot) or {}).get(field)
+            if old is not None:
+                values[old].discard(slot)
+                if not values[old]:
+                    del values[old]
+            new = (metadata or {}).get(field)
+            if new is not None:
+                values.setdefault(new, set()).add(slot)
+        if metadata is None and slot not in self.ids:
+            self.metadatas.pop(slot, None)
+        else:
+            self.metadatas[slot] = metadata
+
+
+    def _grow(self, dimensions: int, needed: int) -> None:
+        capacity = len(self.active)
+        if self.vectors is not None and needed <= capacity:
+            return
+        new_capacity = max(INITIAL_CAPACITY, capacity)
+        while new_capacity < needed:
+            new_capacity *= 2
+
+        # the float32 file last: other processes reopen everything once it is replaced
+        if self.precision != "float32":
+            self.codes = open_array(self.codes_path, np.float16 if self.precision == "float16" else np.int8, (new_capacity, dimensions), self.codes)
+        if self.precision == "int8":
+            self.scales = open_array(self.scales_path, np.float32, (new_capacity,), self.scales)
+        self.vectors = open_array(self.vectors_path, np.float32, (new_capacity, dimensions), self.vectors)
+        self.vectors_inode = os.stat(self.vectors_path).st_ino
+
+        self.active = np.concatenate([self.active, np.zeros(new_capacity - capacity, dtype=bool)])
+        self.free = sorted(set(self.free) | set(range(capacity, new_capacity)), reverse=True)
+
+
+    def _upsert(self, ids, documents=None, metadatas=None, embeddings=None) -> None:
+        if embeddings is None:
+            raise ValueError("the local backend stores precomputed embeddings only")
+        vectors = normalize(embeddings)
+        with self.lock, self.file_lock:
+            self._refresh()
+            new = sum(1 for id in dict.fromkeys(ids) if id not in self.slots)
+            self._grow(vectors.shape[1], len(self.slots) + new)
+
+            rows = []
+            for i, id in enumerate(ids):
+                slot = self.slots.get(id)
+                if slot is None:
+                    slot = self.free.pop()
+                    self.slots[id] = slot
+                    self.ids[slot] = id
+                self._store(slot, vectors[i])
+                self.active[slot] = True
+                self.high_water = max(self.high_water, slot + 1)
+                self.documents[slot] = documents[i] if documents else None
+                self._set_metadata(slot, metadatas[i] if metadatas else None)
+                rows.append((id, slot, self.documents[slot], json.dumps(self.metadatas[slot]) if self.metadatas[slot] is not None else None))
+
+            # vectors first, a crash before the commit leaves only an unreferenced row
+            self._flush()
+            self.conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", rows)
+            self._commit(ids)
+
+
+    def _update(self, ids, metadatas=None, documents=None, embeddings=None) -> None:
+        with self.lock, self.file_lock:
+            self._refresh()
+            known = [(i, id) for i, id in enumerate(ids) if id in self.slots]
+            if embeddings is not None:
+                vectors = normalize(embeddings)
+                for i, id in known:
+                    self._store(self.slots[id], vectors[i])
+                self._flush()
+            for i, id in known:
+                slot = self.slots[id]
+                if metadatas:
+                    self._set_metadata(slot, metadatas[i])
+                if documents:
+                    self.documents[slot] = documents[i]
+            self.conn.executemany("UPDATE records SET document = ?, metadata = ? WHERE id = ?", [
+                (self.documents[self.slots[id]], json.dumps(self.metadatas[self.slots[id]]), id) for _, id in known
+            ])
+            self._commit([id for _, id in known])
+
+
+    def _indexed_slots(self, where: dict):
+        # rows a where filter can match according to field_slots, None when the filter needs a full scan
+        if "$and" in where:
+            found = [slots for slots in (self._indexed_slots(clause) for clause in where["$and"]) if slots is not None]
+            return set.intersection(*found) if found else None
+        if "$or" in where:
+            found = [self._indexed_slots(clause) for clause in where["$or"]]
+            return None if any(slots is None for slots in found) else set().union(*found)
+
+        selected = None
+        for field, condition in where.items():
+            if field not in self.field_slots:
+                continue
+            if not isinstance(condition, dict):
+                values = [condition]
+            elif "$eq" in condition:
+                values = [condition["$eq"]]
+            elif "$in" in condition:
+                values = condition["$in"]
+            else:
+                continue
+            slots = set().union(*(self.field_slots[field].get(value, set()) for value in values))
+            selected = slots if selected is None else selected & slots
+        return selected
+
+
+    def _select(self, ids=None, where=None) -> list:
+        if ids is not None:
+            slots = [self.slots[id] for id in ids if id in self.slots]
+        else:
+            indexed = self._indexed_slots(where) if where else None
+            slots = sorted(indexed if indexed is not None else self.ids)
+        # the index only narrows the rows down, every condition is still checked
+        return [slot for slot in slots if matches(self.metadatas[slot], where)] if where else slots
+
+
+    def _result(self, slots: list, include) -> dict:
+        result = {"ids": [self.ids[slot] for slot in slots]}
+        result["documents"] = [self.documents[slot] for slot in slots] if "documents" in include else None
+        result["metadatas"] = [self.metadatas[slot] for slot in slots] if "metadatas" in include else None
+        result["embeddings"] = [self.vectors[slot].tolist() for slot in slots] if "embeddings" in include else None
+        return result
+
+
+    def _get(self, ids=None, where=None, include=("metadatas", "documents"), limit=None, offset=None) -> dict:
+        with self.lock:
+            self._refresh()
+            slots = self._select(ids, where)
+            start = offset or 0
+            slots = slots[start:start + limit] if limit else slots[start:]
+            return self._result(slots, include)
+
+
+    def _delete(self, ids=None, where=None) -> None:
+        with self.lock, self.file_lock:
+            self._refresh()
+            deleted = [self.ids[slot] for slot in self._select(ids, where)]
+            for id in deleted:
+                slot = self.slots[id]
+                self._forget(id)
+                self.active[slot] = False
+                self.free.append(slot)
+            self.free.sort(reverse=True)
+            self.conn.executemany("DELETE FROM records WHERE id = ?", [(id,) for id in deleted])
+            self._commit(deleted)
+
+
+    def _similarities(self, query: np.ndarray, slots) -> np.ndarray:
+        # similarity of query to the rows in slots (all rows below high_water when None), from the scanned copy
+        matrix = self.vectors if self.codes is None else self.codes
+        similarities = np.empty(len(slots) if slots is not None else self.high_water, dtype=np.float32)
+        for start in range(0, len(similarities), SCAN_BLOCK_ROWS):
+            end = min(start + SCAN_BLOCK_ROWS, len(similarities))
+            rows = slots[start:end] if slots is not None else slice(start, end)
+            similarities[start:end] = matrix[rows].astype(np.float32, copy=False) @ query
+            if self.scales is not None:
+                similarities[start:end] *= self.scales[rows]
+        if slots is None:
+            similarities[~self.active[:self.high_water]] = -np.inf
+        return similarities
+
+
+    def _query(self, query_embeddings, n_results=10, where=None, include=("metadatas", "documents", "distances")) -> dict:
+        queries = normalize(query_embeddings)
+        result = {field: [] for field in ("ids", "distances", "documents", "metadatas", "embeddings")}
+        with self.lock:
+            self._refresh()
+            slots = np.array(self._select(where=where), dtype=np.int64) if where else None
+            candidates = len(slots) if slots is not None else len(self.ids)
+
+            for query in queries:
+                count = min(n_results, candidates)
+                if not count:
+                    top = []
+                    similarities = np.zeros(0, dtype=np.float32)
+                else:
+                    similarities = self._similarities(query, slots)
+                    shortlist = count if self.codes is None else min(candidates, count * self.rescore)
+                    best = np.argpartition(-similarities, shortlist - 1)[:shortlist]
+                    rows = slots[best] if slots is not None else best
+                    if self.codes is not None:
+                        # re-score the shortlist with the full-precision vectors
+                        similarities = self.vectors[np.sort(rows)] @ query
+                        rows = np.sort(rows)
+                    else:
+                        similarities = similarities[best]
+                    order = np.argsort(-similarities)[:count]
+                    top = [int(row) for row in rows[order]]
+                    similarities = similarities[order]
+
+                found = self._result(top, include)
+                result["ids"].append(found["ids"])
+                result["distances"].append([float(1 - similarity) for similarity in similarities])
+                for field in ("documents", "metadatas", "embeddings"):
+                    result[field].append(found[field])
+
+        for field in ("documents", "metadatas", "embeddings", "distances"):
+            if field not in include:
+                result[field] = None
+        return result
+
+
+    def memory_stats(self) -> dict:
+        # bytes a query scans, against the float32 vectors kept for re-scoring
+        with self.lock:
+            self._refresh()
+            scanned = [array for array in ((self.codes, self.scales) if self.codes is not None else (self.vectors,)) if array is not None]
+            return {
+                "precision": self.precision,
+                "rows": len(self.slots),
+                "capacity": len(self.active),
+                "scan_bytes": sum(array.nbytes for array in scanned),
+                "float32_bytes": self.vectors.nbytes if self.vectors is not None else 0,
+            }
+
+
+    async def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        await asyncio.to_thread(self._upsert, ids, documents, metadatas, embeddings)
+
+    upsert = add
+
+
+    async def update(self, ids, metadatas=None, documents=None, embeddings=None):
+        await asyncio.to_thread(self._update, ids, metadatas, documents, embeddings)
+
+
+    async def get(self, ids=None, where=None, include=("metadatas", "documents"), limit=None, offset=None):
+        return await asyncio.to_thread(self._get, ids, where, include, limit, offset)
+
+
+    async def delete(self, ids=None, where=None):
+        await asyncio.to_thread(self._delete, ids, where)
+
+
+    def _count(self) -> int:
+        with self.lock:
+            self._refresh()
+            return len(self.slots)
+
+
+    async def count(self):
+        return await asyncio.to_thread(self._count)
+
+
+    async def query(self, query_embeddings=None, n_results=10, where=None, include=("metadatas", "documents", "distances"), query_texts=None):
+        if query_embeddings is None:
+            raise ValueError("the local backend queries with precomputed embeddings only")
+        return await asyncio.to_thread(self._query, query_embeddings, n_results, where, include)
+
+
+class LocalClient:
+    # what VectorDatabase uses of a chroma client, for collections in a local directory
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.collections = {}
+
+
+    async def heartbeat(self) -> int:
+        return 0
+
+
+    async def get_or_create_collection(self, name: str) -> LocalCollection:
+        if name not in self.collections:
+            self.collections[name] = await asyncio.to_thread(LocalCollection, self.directory, name)
+        return self.collections[name]
@@ -1,24 +1,40 @@
 import asyncio
-from Rag.ocr import extract_text
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from  Rag.cch import add_chunk_header
-from  Rag.vector_db import VectorDatabase
+from contextlib import aclosing
+from Rag.ocr import iter_document_pages
+from Rag.chunker import StreamingChunker, split_pages
+from  Rag.cch import ChunkBatcher, CCH_BATCH_SIZE, add_chunk_headers, cached_chunk_header
+from Rag.cache import cache_key, get_llm_cache
+from Rag.clients import get_client_registry
+from Rag.groq_keys import estimate_tokens, get_key_scheduler
+from  Rag.vector_db import BatchUpserter, OperationMetrics, get_embedding_service, get_vector_db, metadata_chunk_id, normalize_query, scope_filter
+from Rag.answer_cache import get_answer_cache
+from Rag.coalesce import flight_key, get_single_flight
+from Rag.context import (CONTEXT_CANDIDATES, CONTEXT_MIN_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGET, PackingStats,
+                         context_budget, pack_context)
+from Rag.rerank import MMR_FETCH_K
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_groq import ChatGroq
-from concurrent.futures import ThreadPoolExecutor
-from itertools import cycle
-import os
+import hashlib
+import json
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
 GROQ_MODEL_NAME = "llama3-8b-8192"# os.getenv("GROQ_MODEL_NAME")
 MAX_CONTENT_TOKENS = 4000
-
-# GROQ_API_KEYS = os.environ["GROQ_API_KEYS_str"]
-GROQ_API_KEYS= os.getenv("GROQ_API_KEYS_str").split(",")
-
-# print(GROQ_API_KEYS)
-GROQ_API_KEY_CYCLE = cycle(GROQ_API_KEYS)
+# context window of GROQ_MODEL_NAME, the retrieved passages get what the prompt and answer leave
+GROQ_MODEL_CONTEXT_TOKENS = 8192
+# header batches that may be requested at the same time while a document is ingested,
+# extraction waits when that many are pending
+HEADER_WORKERS = 5
+SUMMARY_CHARS = 8000
+# category of documents uploaded without one
+DEFAULT_CATEGORY = "general"
+# latencies of the answer path: retrieval, time_to_first_token and total, see rag_metrics()
+RAG_METRICS = {}
+# tokens, passages and skipped candidates of the packed contexts
+CONTEXT_STATS = PackingStats()
+
+# the Groq keys in GROQ_API_KEYS_str are handed out by Rag.groq_keys
 SYSTEM_DICT_FILE='system_dict.txt'
 
 def get_all_words(file_path):
@@ -42,25 +58,26 @@ SYSTEM = '''
 You are a helpful AI Assistant for the employees of Gas Authority of India Limited (GAIL).
 Answer the user query to the best of your abilities. Keep the answer under 100 words.
 Strictly avoid the use of unprofessional words like {bad_words}. Instead use words of similar meaning that can be used professionally.
-You are given with three chunks of text related to the query. Use the chunks to give the answer.
-If the chunks are not related to the query, say that you did not find any relevant documents. Do not make any assumptions.
-Do not give any information not in the chunks. Also do not mention chunks in the answer.
+You are given numbered passages from documents related to the query, each under a line naming its document and page. Use the passages to give the answer.
+If the passages are not related to the query, say that you did not find any relevant documents. Do not make any assumptions.
+Do not give any information not in the passages. Also do not mention passages in the answer.
 
 
-CHUNK 1:
-{context_1}
-
+PASSAGES:
+{context}
+'''.strip()
 
-CHUNK 2:
-{context_2}
+# stands in for the passages when retrieval found nothing
+NO_CONTEXT = "No relevant passages were found."
 
+HUMAN = "{text}"
 
-CHUNK 3:
-{context_3}
-'''.strip()
 
-HUMAN = "{text}"
+# bump when SYSTEM or HUMAN change so cached answers are not reused
+ANSWER_PROMPT_VERSION = 2
 
+# bump when SUMMARY_SYSTEM or SUMMARY_HUMAN change so cached summaries are not reused
+SUMMARY_PROMPT_VERSION = 1
 
 SUMMARY_SYSTEM = '''You are an AI Assistant that summarizes large texts to make it short and concise. 
 Keep the summary easy to read.'''
@@ -74,87 +91,317 @@ Title: {filename}
 
 
 def get_text_chunks(text: str):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    return text_splitter.split_text(text)
+    return [chunk["text"] for chunk in split_pages([(1, text)])]
 
 
-async def summarize(file_path: str, file_name: str, text: str) -> None:
-    chat = ChatGroq(temperature=0, groq_api_key=next(GROQ_API_KEY_CYCLE), model_name=GROQ_MODEL_NAME, max_tokens=MAX_CONTENT_TOKENS, max_retries=2)
+def file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    prompt = ChatPromptTemplate.from_messages([("system", SUMMARY_SYSTEM), ("human", SUMMARY_HUMAN)])
 
-    
-    chain = prompt | chat
-    response = chain.invoke({"filename": file_name, "text":text[:8000]})
-    print(response)
+def chunk_hash(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
 
-    with open(f'summaries/{file_name[:-3]}txt', 'w') as f:
-        f.write(response.content)
 
+def stored_chunk_ids(stored: dict) -> dict:
+    # chunk hash -> ids of the stored chunks with that text, a document can repeat a chunk
+    ids_by_hash = {}
+    for id, metadata in zip(stored["ids"], stored["metadatas"]):
+        ids_by_hash.setdefault((metadata or {}).get("chunk_hash"), []).append(id)
+    return ids_by_hash
 
-async def add_document(file_path: str, file_name: str):
-    print("extracting text...")
-    text = extract_text(file_path)
-    await summarize(file_path=file_path, file_name=file_name, text=text)
 
-    print("creating chunks...")
-    chunks = get_text_chunks(text=text)
-    chunks_with_headers = []
-    print(f'created {len(chunks)} chunks...')
+def ingestion_complete(stored: dict, doc_hash: str, category: str) -> bool:
+    # chunks are upserted batch by batch, so after a failed ingestion some already carry the new
+    # doc_hash; only the marker written once everything is stored says this version is complete
+    metadatas = [metadata or {} for metadata in stored["metadatas"]]
+    if not metadatas or any(metadata.get("doc_hash") != doc_hash or metadata.get("category") != category for metadata in metadatas):
+        return False
+    return any(metadata.get("ingested_hash") == doc_hash and metadata.get("doc_chunks") == len(metadatas) for metadata in metadatas)
 
 
-    file_name=file_name
+async def iterate_in_thread(iterator):
+    # async view of a blocking iterator, every next() runs in a worker thread
+    done = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, done)
+        if item is done:
+            return
+        yield item
 
-    print("creating chunk headers...")
-    
-    li = list(range(len(chunks)))
 
-    def process_chunk(chunk, i):
-        print("creating chunk", i+1)
-        return add_chunk_header(doc_title=file_name, content=chunk, GROQ_API_KEY=next(GROQ_API_KEY_CYCLE))
-    
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        results = executor.map(process_chunk, chunks, li)
-    
-    chunks_with_headers.extend(results)    
+async def summarize(file_path: str, file_name: str, text: str) -> None:
+    key = cache_key("summary", GROQ_MODEL_NAME, SUMMARY_PROMPT_VERSION, file_name, text[:SUMMARY_CHARS])
+    summary = get_llm_cache().get(key)
+
+    if summary is None:
+        prompt = ChatPromptTemplate.from_messages([("system", SUMMARY_SYSTEM), ("human", SUMMARY_HUMAN)])
 
-    print("created chunk headers")
-    print(chunks_with_headers[:5])
+        def call(GROQ_API_KEY):
+            chat = get_client_registry().chat(GROQ_API_KEY, GROQ_MODEL_NAME, MAX_CONTENT_TOKENS)
+            chain = prompt | chat
+            return chain.ainvoke({"filename": file_name, "text":text[:SUMMARY_CHARS]})
 
+        response = await get_key_scheduler().arun(call, estimate_tokens(SUMMARY_SYSTEM, SUMMARY_HUMAN, file_name, text[:SUMMARY_CHARS], max_tokens=MAX_CONTENT_TOKENS))
+        print(response)
+        summary = response.content
+        get_llm_cache().set(key, summary)
 
-    print("creating embeddings...")
-    chroma_db = VectorDatabase()
-    await chroma_db.add_to_vector_store(chunks=chunks_with_headers)
-    print("embeddings created")
+    with open(f'summaries/{file_name[:-3]}txt', 'w') as f:
+        f.write(summary)
+
+
+def no_progress(**fields) -> None:
+    pass
+
+
+async def add_document(file_path: str, file_name: str, progress=no_progress, category: str = None) -> dict:
+    """
+    Extracts, chunks, heads and embeds a document as one pipeline: chunks are cut while later
+    pages are still being extracted, and header requests and embedding start as soon as a batch is full.
+    Chunks already stored for the document are kept, only new ones are embedded and stale ones deleted.
+    Every chunk carries doc_name, category, upload_date and its pages, so questions can be scoped to them.
+    """
+    category = category or DEFAULT_CATEGORY
+    upload_date = time.strftime("%Y-%m-%d")
+    chroma_db = get_vector_db()
+    progress(stage="fingerprinting")
+    doc_hash = await asyncio.to_thread(file_hash, file_path)
+    stored = await chroma_db.get_document_chunks(doc_name=file_name)
+
+    if ingestion_complete(stored, doc_hash, category):
+        print(f"{file_name} is unchanged, skipping ingestion")
+        return {"unchanged": True, "chunks": len(stored["ids"])}
+
+    stats = {}
+    stored_ids = stored_chunk_ids(stored)
+    kept, added = [], []
+    cached_headers = 0
+
+    chunker = StreamingChunker()
+    batcher = ChunkBatcher()
+    ready = []  # added chunks whose header came from the cache
+    tasks = set()
+    errors = []
+    slots = asyncio.Semaphore(HEADER_WORKERS)
+    upserter = BatchUpserter(chroma_db, progress=lambda stored: progress(stage="embedding", chunks_embedded=stored))
+
+    summary_text = ""
+    summary_task = None
+
+    def chunk_metadata(chunk):
+        return {"doc_name": file_name, "doc_hash": doc_hash, "category": category, "upload_date": upload_date,
+                "page": chunk["page_start"], "page_end": chunk["page_end"], "chunk_index": chunk["chunk_index"], "chunk_hash": chunk["hash"]}
+
+    async def embed_batch(batch):
+        try:
+            missing = [chunk for chunk in batch if "headed" not in chunk]
+            if missing:
+                print("creating chunks", missing[0]["chunk_index"]+1, "to", missing[-1]["chunk_index"]+1)
+                headed = await add_chunk_headers(file_name, [chunk["text"] for chunk in missing])
+                for chunk, headed_chunk in zip(missing, headed):
+                    chunk["headed"] = headed_chunk
+
+            await upserter.add([chunk["headed"] for chunk in batch], [chunk_metadata(chunk) for chunk in batch])
+        finally:
+            slots.release()
+
+    def batch_done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            errors.append(task.exception())
+
+    async def start_batch(batch):
+        # waits while HEADER_WORKERS batches are pending, that is what holds extraction back
+        await slots.acquire()
+        if errors:
+            slots.release()
+            raise errors[0]
+        task = asyncio.create_task(embed_batch(batch))
+        tasks.add(task)
+        task.add_done_callback(batch_done)
+
+    async def handle_chunk(chunk):
+        nonlocal cached_headers
+        chunk["hash"] = chunk_hash(chunk["text"])
+        ids = stored_ids.get(chunk["hash"])
+        if ids:
+            kept.append((chunk, ids.pop()))
+            return
+
+        added.append(chunk)
+        header = cached_chunk_header(doc_title=file_name, content=chunk["text"])
+        if header is not None:
+            cached_headers += 1
+            chunk["headed"] = header + chunk["text"]
+            ready.append(chunk)
+            if len(ready) >= CCH_BATCH_SIZE:
+                await start_batch(ready[:])
+                ready.clear()
+            return
+
+        for batch in batcher.add(chunk, chunk["text"]):
+            await start_batch(batch)
+
+    print("extracting and chunking text...")
+    try:
+        async for page_number, page_text in iterate_in_thread(iter_document_pages(file_path, stats=stats)):
+            progress(stage="extracting", pages_done=page_number, pages_total=stats["pages"], chunks_total=chunker.chunk_index)
+
+            if summary_task is None:
+                summary_text += page_text + "\n"
+                if len(summary_text) >= SUMMARY_CHARS:
+                    summary_task = asyncio.create_task(summarize(file_path=file_path, file_name=file_name, text=summary_text))
+
+            for chunk in chunker.add_page(page_number, page_text):
+                await handle_chunk(chunk)
+
+        for chunk in chunker.finish():
+            await handle_chunk(chunk)
+        print(f"extracted {stats['pages']} pages: {stats['text_layer_pages']} from text layer, {stats['ocr_pages']} with OCR")
+
+        if summary_task is None:
+            summary_task = asyncio.create_task(summarize(file_path=file_path, file_name=file_name, text=summary_text))
+        for batch in (ready, batcher.flush()):
+            if batch:
+                await start_batch(batch)
+
+        progress(stage="embedding", chunks_total=chunker.chunk_index)
+        await asyncio.gather(summary_task, *tasks)
+        if errors:
+            raise errors[0]
+        chunks_embedded = await upserter.flush()
+    except BaseException:
+        for task in [summary_task, *tasks]:
+            if task:
+                task.cancel()
+        upserter.cancel()
+        raise
+
+    # unchanged chunks keep their embeddings, only their position, doc hash, category and date move
+    await chroma_db.update_metadata(ids=[id for _, id in kept], metadatas=[chunk_metadata(chunk) for chunk, _ in kept])
+    removed = [id for ids in stored_ids.values() for id in ids]
+    if removed:
+        await chroma_db.delete_from_vector_store(ids=removed)
+    print(f"{len(kept)} chunks unchanged, {len(added)} added, {len(removed)} removed")
+    # answers about the old version of the document may be wrong now
+    await asyncio.to_thread(get_answer_cache().invalidate, doc_names=[file_name])
+
+    # written last, on the first chunk: an ingestion that stops before this is redone, not skipped
+    first = [(chunk, id) for chunk, id in kept if chunk["chunk_index"] == 0] + \
+            [(chunk, metadata_chunk_id(chunk_metadata(chunk))) for chunk in added if chunk["chunk_index"] == 0]
+    for chunk, id in first[:1]:
+        await chroma_db.update_metadata(ids=[id], metadatas=[{**chunk_metadata(chunk), "ingested_hash": doc_hash, "doc_chunks": chunker.chunk_index}])
+    progress(stage="embedded", chunks_embedded=chunks_embedded)
+
+    stats.update({
+        "chunks": chunker.chunk_index,
+        "chunks_kept": len(kept),
+        "chunks_added": len(added),
+        "chunks_removed": len(removed),
+        "cached_chunk_headers": cached_headers,
+    })
+    print("llm cache:", get_llm_cache().stats())
+    return stats
     
 
 
-async def llm_response(query: str):
-    chroma_db = VectorDatabase()
-    similar_chunks = await chroma_db.query_vector_store(query=query, n_results=3)
+def answer_context(scope: dict) -> str:
+    # a cached answer is only reused for the same model, prompt and scope
+    return json.dumps([GROQ_MODEL_NAME, ANSWER_PROMPT_VERSION, BADWORDS, CONTEXT_MIN_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGET, scope or {}], sort_keys=True)
 
-    relevant_data = similar_chunks["documents"][0]
 
-    print("number of similar chunks found:", len(relevant_data))
+def record_timing(operation: str, elapsed_ms: float) -> None:
+    RAG_METRICS.setdefault(operation, OperationMetrics()).record(elapsed_ms)
 
-    for data in relevant_data:
-        print(data)
 
-    while len(relevant_data) < 3:
-        relevant_data.append("No more relevant data found.")
+def rag_metrics() -> dict:
+    return {**{operation: metrics.summary() for operation, metrics in RAG_METRICS.items()}, "context": CONTEXT_STATS.summary(),
+            "coalescing": get_single_flight().stats()}
 
 
-    chat = ChatGroq(temperature=0, groq_api_key=next(GROQ_API_KEY_CYCLE), model_name=GROQ_MODEL_NAME, max_tokens=MAX_CONTENT_TOKENS, max_retries=2)
+async def llm_response(query: str, scope: dict = None):
+    """
+    Async generator: yields the answer as text pieces as the model produces them, then one dict
+    {"type": "done", "source_chunk_ids", "sources", "timings", "cached"} for the client to close on.
+    Identical questions (same normalized text, scope and prompt) asked while one is being answered
+    share that answer's stream, across workers when REDIS_URL is set; theirs is marked "coalesced".
+    """
+    key = flight_key(normalize_query(query), answer_context(scope))
+    async with aclosing(get_single_flight().stream(key, lambda: generate_answer(query, scope))) as frames:
+        async for frame in frames:
+            yield frame
 
-    prompt = ChatPromptTemplate.from_messages([("system", SYSTEM), ("human", HUMAN)])
 
+async def generate_answer(query: str, scope: dict = None):
+    # one answer for llm_response, computed without coalescing
+    # scope restricts retrieval to documents or categories, see scope_filter
+    start = time.perf_counter()
 
-    chain = prompt | chat
-    response = chain.invoke({"bad_words": BADWORDS, "context_1": relevant_data[0], "context_2": relevant_data[1], "context_3": relevant_data[2], "text":query})
-    
-    print(response)
+    def elapsed_ms():
+        return round((time.perf_counter() - start) * 1000, 3)
 
-    return response.content
+    answer_cache = get_answer_cache()
+    query_embedding = await get_embedding_service().embed_query(query)
+    cached = await asyncio.to_thread(answer_cache.lookup, query_embedding, answer_context(scope))
+    if cached:
+        print(f"answer cache hit ({cached['similarity']}): {cached['query']}")
+        first_token_ms = elapsed_ms()
+        yield cached["answer"]
+        record_timing("time_to_first_token", first_token_ms)
+        record_timing("total", elapsed_ms())
+        yield {"type": "done", "source_chunk_ids": cached["chunk_ids"], "sources": [{"id": chunk_id, "doc_name": doc_name} for chunk_id, doc_name in zip(cached["chunk_ids"], cached["doc_names"])],
+               "timings": {"retrieval_ms": None, "time_to_first_token_ms": first_token_ms, "total_ms": elapsed_ms()}, "cached": True}
+        return
+
+    chroma_db = get_vector_db()
+    similar_chunks = await chroma_db.retrieve(query=query, n_results=CONTEXT_CANDIDATES, where=scope_filter(scope),
+                                              fetch_k=max(MMR_FETCH_K, CONTEXT_CANDIDATES))
+    retrieval_ms = elapsed_ms()
+    record_timing("retrieval", retrieval_ms)
+
+    # as many of the ranked candidates as the question's token budget holds
+    available = GROQ_MODEL_CONTEXT_TOKENS - estimate_tokens(SYSTEM, BADWORDS, query, max_tokens=MAX_CONTENT_TOKENS)
+    packed = pack_context(similar_chunks["ids"][0], similar_chunks["documents"][0], similar_chunks["metadatas"][0], context_budget(query, available))
+    CONTEXT_STATS.record(packed)
+    chunk_ids = packed["ids"]
+    metadatas = packed["metadatas"]
+    doc_names = [metadata.get("doc_name") for metadata in metadatas]
+    context = packed["context"] or NO_CONTEXT
+
+    print(f"packed {len(chunk_ids)} of {len(similar_chunks['ids'][0])} chunks, {packed['tokens']}/{packed['budget']} tokens")
+
+
+    prompt = ChatPromptTemplate.from_messages([("system", SYSTEM), ("human", HUMAN)])
+    prompt_input = {"bad_words": BADWORDS, "context": context, "text":query}
+
+    def call(GROQ_API_KEY):
+        chat = get_client_registry().chat(GROQ_API_KEY, GROQ_MODEL_NAME, MAX_CONTENT_TOKENS)
+        chain = prompt | chat
+        return chain.astream(prompt_input)
+
+    parts = []
+    first_token_ms = None
+    prompt_tokens = estimate_tokens(SYSTEM, BADWORDS, context, query)
+    async for chunk in get_key_scheduler().astream(call, prompt_tokens + MAX_CONTENT_TOKENS, prompt_tokens=prompt_tokens):
+        if not chunk.content:
+            continue
+        if first_token_ms is None:
+            first_token_ms = elapsed_ms()
+            record_timing("time_to_first_token", first_token_ms)
+        parts.append(chunk.content)
+        yield chunk.content
+
+    answer = "".join(parts)
+    record_timing("total", elapsed_ms())
+    await asyncio.to_thread(answer_cache.store, query, query_embedding, answer_context(scope), answer, chunk_ids, doc_names)
+    yield {"type": "done", "source_chunk_ids": chunk_ids,
+           "sources": [{"id": chunk_id, "doc_name": metadata.get("doc_name"), "page": metadata.get("page")} for chunk_id, metadata in zip(chunk_ids, metadatas)],
+           "timings": {"retrieval_ms": retrieval_ms, "time_to_first_token_ms": first_token_ms, "total_ms": elapsed_ms()},
+           "context_tokens": packed["tokens"], "context_budget": packed["budget"], "cached": False}
 
 
 
@@ -1,21 +1,257 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from Rag.cache import DiskLRUCache, cache_key
+import pdfplumber
 import pytesseract
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 
 
-def extract_text(pdf_file_path:str):
-    
-    pages = convert_from_path(pdf_file_path)
+# the cores this process may run on, which in a container or under taskset can be fewer than the machine's
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1))
+OCR_PAGES_PER_TASK = int(os.getenv("OCR_PAGES_PER_TASK", 2))
+OCR_DPI = int(os.getenv("OCR_DPI", 200))
+# pages whose text layer has fewer printable characters than this are treated as scanned
+MIN_TEXT_LAYER_CHARS = int(os.getenv("MIN_TEXT_LAYER_CHARS", 50))
 
-    text = ""
-    for page in pages:
-    #   display(page)
-        text += pytesseract.image_to_string(page) + "\n"
-        # print(text)
-    
+# recognized text of rasterized pages, shared by all workers and documents
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", "cache/ocr_cache.sqlite3")
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+
+def _init_ocr_worker():
+    # every worker already owns a core, keep tesseract from spawning its own threads on top
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+_ocr_cache = None
+_tesseract_version = None
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+
+def get_ocr_pool() -> ProcessPoolExecutor:
+    """
+    The process pool every document's OCR runs on, so documents ingested at the same time share
+    OCR_WORKERS processes instead of starting a pool each. Workers are started by a forkserver
+    (spawned where there is none) rather than forked from whichever ingestion thread comes first.
+    """
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _ocr_pool = ProcessPoolExecutor(max_workers=max(1, OCR_WORKERS), mp_context=multiprocessing.get_context(method),
+                                            initializer=_init_ocr_worker)
+        return _ocr_pool
+
+
+def shutdown_ocr_pool() -> None:
+    global _ocr_pool
+    with _ocr_pool_lock:
+        pool, _ocr_pool = _ocr_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _discard_broken_pool(pool: ProcessPoolExecutor) -> None:
+    # a worker that died breaks the pool for good, the next document gets a new one
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is pool:
+            _ocr_pool = None
+
+def get_ocr_cache() -> DiskLRUCache:
+    # one connection per process, worker processes open their own
+    global _ocr_cache
+    if _ocr_cache is None:
+        _ocr_cache = DiskLRUCache(OCR_CACHE_PATH, OCR_CACHE_MAX_BYTES)
+    return _ocr_cache
+
+
+def page_cache_key(page) -> str:
+    # the rendered pixels identify a page, so identical scans in different documents share an entry
+    global _tesseract_version
+    if _tesseract_version is None:
+        _tesseract_version = str(pytesseract.get_tesseract_version())
+    digest = hashlib.sha256(page.tobytes()).hexdigest()
+    return cache_key("ocr", _tesseract_version, page.mode, page.size, digest)
+
+
+def ocr_page(page) -> str:
+    cache = get_ocr_cache()
+    key = page_cache_key(page)
+    text = cache.get(key)
+    if text is None:
+        text = pytesseract.image_to_string(page)
+        cache.set(key, text)
     return text
 
+
+def get_page_count(pdf_file_path: str) -> int:
+    return pdfinfo_from_path(pdf_file_path)["Pages"]
+
+
+def ocr_page_range(pdf_file_path: str, first_page: int, last_page: int) -> list:
+    # runs inside a worker, so only this range's page images are ever held in memory
+    pages = convert_from_path(pdf_file_path, dpi=OCR_DPI, first_page=first_page, last_page=last_page)
+    return [ocr_page(page) for page in pages]
+
+
+def group_page_ranges(page_numbers: list, pages_per_task: int) -> list:
+    # contiguous runs of at most pages_per_task pages, so each task is a single pdftoppm call
+    ranges = []
+    for number in page_numbers:
+        if ranges and ranges[-1][1] == number - 1 and number - ranges[-1][0] < pages_per_task:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return [tuple(page_range) for page_range in ranges]
+
+
+def iter_page_text(pdf_file_path: str, page_numbers: list = None, pages_per_task: int = OCR_PAGES_PER_TASK, workers: int = OCR_WORKERS):
+    """
+    Yield (page_number, text) for the given pages of the pdf (all pages by default), in page order.
+    Pages are rasterized and OCRed a few at a time on the shared pool (get_ocr_pool). At most
+    2 * workers page ranges of this document are in flight, which keeps memory bounded regardless of page count.
+    """
+    if page_numbers is None:
+        page_numbers = range(1, get_page_count(pdf_file_path) + 1)
+    page_ranges = iter(group_page_ranges(sorted(page_numbers), pages_per_task))
+    max_in_flight = max(1, workers) * 2
+
+    executor = get_ocr_pool()
+    pending = deque()
+
+    def submit_next():
+        page_range = next(page_ranges, None)
+        if page_range:
+            pending.append((page_range[0], executor.submit(ocr_page_range, pdf_file_path, *page_range)))
+
+    try:
+        for _ in range(max_in_flight):
+            submit_next()
+
+        while pending:
+            first_page, future = pending.popleft()
+            try:
+                texts = future.result()
+            except BrokenProcessPool:
+                _discard_broken_pool(executor)
+                raise
+            submit_next()
+
+            for offset, text in enumerate(texts):
+                yield first_page + offset, text
+    finally:
+        # also reached when the consumer stops iterating early; the pool stays up for other documents
+        for _, future in pending:
+            future.cancel()
+
+
+def has_text_layer(text: str) -> bool:
+    # "(cid:" markers come from fonts without a unicode map, that text is unusable for retrieval
+    printable = sum(1 for char in text if char.isprintable() and not char.isspace())
+    return printable >= MIN_TEXT_LAYER_CHARS and text.count("(cid:") * 10 < printable
+
+
+def iter_document_pages(pdf_file_path: str, stats: dict = None, pages_per_task: int = OCR_PAGES_PER_TASK, workers: int = OCR_WORKERS):
+    """
+    Yield (page_number, text) for every page, in page order, as soon as it is available.
+    Pages with a usable text layer are read natively with pdfplumber and come out as they are read,
+    scanned or image-only pages go to the OCR pool in ranges while the pages after them are still
+    being read. At most 2 * workers OCR ranges are in flight. If stats is given it gets the page
+    count up front and then how many pages took each path.
+    """
+    stats = {} if stats is None else stats
+    max_in_flight = max(1, workers) * 2
+    executor = get_ocr_pool()
+    pending = deque()    # (page number, its text or the OCR range it is in), in page order
+    ranges = deque()     # OCR ranges submitted and not yielded yet, oldest first
+    collecting = None    # the OCR range still being collected, contiguous pages only
+
+    def submit_range():
+        nonlocal collecting
+        if collecting is not None:
+            collecting["future"] = executor.submit(ocr_page_range, pdf_file_path, collecting["first"], collecting["last"])
+            ranges.append(collecting)
+            collecting = None
+
+    def available(block: bool):
+        # the pages at the front of pending whose text is there, waiting for OCR when block
+        while pending:
+            number, item = pending[0]
+            if isinstance(item, dict):
+                if item["future"] is None or not (block or item["future"].done()):
+                    return
+                try:
+                    text = item["future"].result()[number - item["first"]]
+                except BrokenProcessPool:
+                    _discard_broken_pool(executor)
+                    raise
+                if number == item["last"]:
+                    ranges.popleft()
+            else:
+                text = item
+            pending.popleft()
+            yield number, text
+
+    try:
+        with pdfplumber.open(pdf_file_path) as pdf:
+            stats.update({"pages": len(pdf.pages), "text_layer_pages": 0, "ocr_pages": 0})
+            for number, page in enumerate(pdf.pages, start=1):
+                text = page.extract_text() or ""
+                page.close()
+                if has_text_layer(text):
+                    submit_range()
+                    stats["text_layer_pages"] += 1
+                    pending.append((number, text))
+                else:
+                    stats["ocr_pages"] += 1
+                    if collecting is None:
+                        collecting = {"first": number, "last": number, "future": None}
+                    collecting["last"] = number
+                    pending.append((number, collecting))
+                    if number - collecting["first"] + 1 >= pages_per_task:
+                        submit_range()
+
+                if len(ranges) >= max_in_flight:
+                    # as many ranges as the pool should hold, read no further until the oldest is done
+                    wait([ranges[0]["future"]])
+                yield from available(block=False)
+
+        submit_range()
+        yield from available(block=True)
+    finally:
+        # also reached when the consumer stops iterating early; the pool stays up for other documents
+        for page_range in ranges:
+            page_range["future"].cancel()
+
+
+def extract_text(pdf_file_path:str, stats: dict = None):
+    return "".join(text + "\n" for _, text in iter_document_pages(pdf_file_path, stats=stats))
+
 if __name__ == "__main__":
-    extract_text("Types_of_Arrhythmia_Detection_using_ML.pdf")
+    # python -m Rag.ocr extract <pdf> | python -m Rag.ocr cache-stats
+    parser = argparse.ArgumentParser(description="text extraction and OCR cache tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    extract_command = commands.add_parser("extract", help="extract a pdf and print per page text lengths")
+    extract_command.add_argument("pdf")
+    commands.add_parser("cache-stats", help="print OCR cache hit rate and size")
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        stats = {}
+        for page_number, text in iter_document_pages(args.pdf, stats=stats):
+            print(page_number, len(text))
+        print(stats)
+    else:
+        print(json.dumps(get_ocr_cache().stats(), indent=4))
 
 # import pymupdf
 
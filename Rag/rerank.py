@@ -0,0 +1,43 @@
+import os
+import numpy as np
+
+
+# 1 ranks by relevance only, 0 by diversity only
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7))
+# candidates fetched for the re-ranking to choose from
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", 12))
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def mmr(query_embedding, embeddings, k: int, lambda_mult: float = MMR_LAMBDA) -> list:
+    """
+    Maximal marginal relevance: picks k of the candidate embeddings one at a time, each time the one
+    with the best lambda * similarity to the query - (1 - lambda) * similarity to the closest one picked.
+    Overlapping neighbour chunks are nearly identical, so after one of them the rest drop down the list.
+    Returns indices into embeddings in the order they were picked.
+    """
+    if len(embeddings) == 0 or k <= 0:
+        return []
+    candidates = normalize_rows(embeddings)
+    relevance = candidates @ normalize_rows(query_embedding)
+    # pairwise similarities once, the loop below only takes maxima over them
+    similarity = candidates @ candidates.T
+
+    picked = [int(np.argmax(relevance))]
+    # similarity of every candidate to the closest picked one
+    redundancy = similarity[picked[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[picked[0]] = False
+
+    while len(picked) < min(k, len(candidates)):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return picked
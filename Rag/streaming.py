@@ -0,0 +1,43 @@
+import asyncio
+import os
+from contextlib import aclosing
+from Rag.clients import get_client_registry
+from Rag.groq_keys import chunk_text, estimate_tokens, get_key_scheduler
+
+
+# longest wait for the next streamed chunk, seconds, before the generation is given up on
+STREAM_CHUNK_TIMEOUT = float(os.getenv("STREAM_CHUNK_TIMEOUT", 30))
+
+
+async def completion_chunks(api_key: str, request: dict, chunk_timeout: float):
+    stream = await get_client_registry().async_groq(api_key).chat.completions.create(stream=True, **request)
+    chunks = stream.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), chunk_timeout)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        # also when the consumer stops early or is cancelled, the response isn't left open
+        await stream.close()
+
+
+async def stream_chat_completion(messages: list, model: str, max_tokens: int, chunk_timeout: float = STREAM_CHUNK_TIMEOUT, **params):
+    """
+    Async generator over the text deltas of a streamed Groq chat completion, read on the pooled
+    async client of a key from the key scheduler, so waiting for tokens never blocks the event loop.
+    Waiting longer than chunk_timeout for the next chunk raises TimeoutError. Closing the generator
+    early, or cancelling the task iterating it, closes the HTTP response and releases the key,
+    giving back what the completion didn't use of its max_tokens reservation.
+    """
+    request = {"model": model, "messages": messages, "max_tokens": max_tokens, **params}
+    prompt_tokens = estimate_tokens(*(message["content"] for message in messages))
+    chunks = get_key_scheduler().astream(lambda api_key: completion_chunks(api_key, request, chunk_timeout),
+                                         prompt_tokens + max_tokens, prompt_tokens=prompt_tokens)
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            # the last chunk only carries the usage
+            if chunk.choices:
+                yield chunk_text(chunk)
@@ -1,77 +1,616 @@
 import asyncio
+import hashlib
+import os
+import sys
+import time
+import uuid
+from collections import OrderedDict, deque
 import chromadb
+import httpx
 from chromadb.utils import embedding_functions
-from chromadb.config import Settings
+from Rag.answer_cache import get_answer_cache
+from Rag.bm25 import FILTER_FIELDS, get_bm25_index, reciprocal_rank_fusion
+from Rag.local_index import LocalClient
+from Rag.rerank import MMR_FETCH_K, MMR_LAMBDA, mmr
 
 
-PERSIST_DIRECTORY = "test_db"
+PERSIST_DIRECTORY = os.getenv("PERSIST_DIRECTORY", "test_db")
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 
+# "http" talks to a chroma server, "local" keeps the collection in this process under PERSIST_DIRECTORY
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "http")
 
-class VectorDatabase:
+CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", 8000))
+CHROMA_COLLECTION = os.getenv("CHROMA_COLLECTION", "prod")
+CHROMA_HEALTH_CHECK_INTERVAL = float(os.getenv("CHROMA_HEALTH_CHECK_INTERVAL", 30))
+
+# latency samples kept per operation for the percentiles
+LATENCY_SAMPLES = 1000
+
+# errors after which the client is rebuilt and the operation retried once
+CONNECTION_ERRORS = (httpx.TransportError, ConnectionError)
+
+MIGRATION_BATCH_SIZE = 500
+
+# chunks per upsert request, and how many of those requests may be in flight at once
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 64))
+UPSERT_MAX_IN_FLIGHT = int(os.getenv("UPSERT_MAX_IN_FLIGHT", 2))
+# a failed batch is retried on its own, waiting UPSERT_RETRY_DELAY, 2x, 4x... seconds
+UPSERT_RETRIES = int(os.getenv("UPSERT_RETRIES", 3))
+UPSERT_RETRY_DELAY = float(os.getenv("UPSERT_RETRY_DELAY", 1))
+
+# candidates each retriever contributes before the rankings are fused
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", 20))
+
+# a query embedding waits at most EMBEDDING_MAX_WAIT_MS for others to share its batch
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", 32))
+EMBEDDING_MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", 5))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 10000))
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def scope_filter(scope: dict):
+    """
+    where filter for the documents and categories a question is restricted to, e.g.
+    {"doc_name": "Leave_Policy.pdf"} or {"category": ["HR", "Finance"]}. None searches everything.
+    """
+    if not scope:
+        return None
+    unknown = set(scope) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"retrieval can't be scoped by {', '.join(sorted(unknown))}, only by {', '.join(FILTER_FIELDS)}")
+
+    clauses = []
+    for field in FILTER_FIELDS:
+        value = scope.get(field)
+        if isinstance(value, (list, tuple)):
+            if value:
+                clauses.append({field: {"$in": list(value)}})
+        elif value:
+            clauses.append({field: value})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def chunk_id(doc_name: str, doc_hash: str, chunk_index: int) -> str:
+    """
+    Id of a chunk, derived from its document and position so that any worker, process or node
+    computes the same id without coordinating. Re-ingesting the same file gives the same ids.
+    """
+    doc_key = hashlib.sha256(f"{doc_name}\0{doc_hash}".encode("utf-8")).hexdigest()[:24]
+    return f"{doc_key}-{chunk_index}"
+
+
+def metadata_chunk_id(metadata: dict):
+    if metadata and all(field in metadata for field in ("doc_name", "doc_hash", "chunk_index")):
+        return chunk_id(metadata["doc_name"], metadata["doc_hash"], metadata["chunk_index"])
+    return None
+
+
+class OperationMetrics:
     def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+
+
+    def record(self, elapsed_ms: float, failed: bool = False) -> None:
+        self.count += 1
+        self.errors += failed
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.samples.append(elapsed_ms)
+
+
+    def summary(self) -> dict:
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 3) if samples else None
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+class Histogram:
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+
+
+    def record(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+
+    def summary(self) -> dict:
+        labels = [f"<={bound}" for bound in self.buckets] + [f">{self.buckets[-1]}"]
+        return dict(zip(labels, self.counts))
+
+
+def normalize_query(text: str) -> str:
+    # "What is the leave policy?" and "what is the  leave policy" share a cache entry
+    return " ".join(text.lower().split()).rstrip("?.! ")
+
+
+def load_embedding_function():
+    # all-MiniLM-L6-v2 is what the chroma server embeds with, its onnx build runs on CPU without torch
+    if EMBEDDING_MODEL.endswith("all-MiniLM-L6-v2"):
+        return embedding_functions.ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL, device="cpu")
+
+
+class EmbeddingService:
+    """
+    Computes embeddings in-process with EMBEDDING_MODEL on CPU. Concurrent query embeddings are
+    collected into micro-batches, and query embeddings are kept in an LRU cache by normalized
+    text, so popular questions are embedded once. Batch sizes and latencies go into histograms.
+    """
+
+    def __init__(self, embedding_function=None, max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE,
+                 max_wait_ms: float = EMBEDDING_MAX_WAIT_MS, cache_size: int = QUERY_EMBEDDING_CACHE_SIZE) -> None:
+        self.embedding_function = embedding_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.queue = None
+        self.batch_task = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.latencies = Histogram(LATENCY_BUCKETS_MS)
+
+
+    def _embed_sync(self, texts: list) -> list:
+        if self.embedding_function is None:
+            self.embedding_function = load_embedding_function()
+        start = time.perf_counter()
+        vectors = [[float(value) for value in vector] for vector in self.embedding_function(texts)]
+        self.batch_sizes.record(len(texts))
+        self.latencies.record((time.perf_counter() - start) * 1000)
+        return vectors
+
+
+    async def embed_documents(self, texts: list) -> list:
+        # documents already arrive in batches, they skip the micro-batcher and the cache
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            vectors.extend(await asyncio.to_thread(self._embed_sync, texts[start:start + self.max_batch_size]))
+        return vectors
+
+
+    async def embed_query(self, text: str) -> list:
+        key = normalize_query(text)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.cache_hits += 1
+            return self.cache[key]
+        self.cache_misses += 1
+
+        # identical queries waiting for the same batch share its result
+        future = self.pending.get(key)
+        if future is None:
+            if self.batch_task is None or self.batch_task.done():
+                self.queue = asyncio.Queue()
+                self.batch_task = asyncio.create_task(self._batch_loop())
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+            self.queue.put_nowait((key, future))
+        return await asyncio.shield(future)
+
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                vectors = await asyncio.to_thread(self._embed_sync, [key for key, _ in batch])
+            except Exception as e:
+                for key, future in batch:
+                    self.pending.pop(key, None)
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (key, future), vector in zip(batch, vectors):
+                self.pending.pop(key, None)
+                self.cache[key] = vector
+                if not future.done():
+                    future.set_result(vector)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+
+    def stats(self) -> dict:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "query_cache": {
+                "entries": len(self.cache),
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+            },
+            "batch_size_histogram": self.batch_sizes.summary(),
+            "latency_ms_histogram": self.latencies.summary(),
+        }
+
+
+_embedding_service = None
+
+def get_embedding_service() -> EmbeddingService:
+    global _embedding_service
+    if _embedding_service is None:
+        _embedding_service = EmbeddingService()
+    return _embedding_service
+
+
+class VectorDatabase:
+    """
+    Client for the chroma collection. Use the process-wide instance from get_vector_db(): it keeps
+    one HTTP client (and its keep-alive connection pool) and the collection handle for the lifetime
+    of the app, rebuilds them when the server goes away, and records latency per operation.
+    With backend="local" the collection lives in this process instead (Rag.local_index), same API.
+    """
+
+    def __init__(self, host: str = CHROMA_HOST, port: int = CHROMA_PORT, collection_name: str = CHROMA_COLLECTION, backend: str = VECTOR_BACKEND) -> None:
+        if backend not in ("http", "local"):
+            raise ValueError(f"unknown vector backend {backend!r}, use http or local")
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.collection_name = collection_name
         self.chroma_client = None
         self.collection = None
+        self.connect_lock = asyncio.Lock()
+        self.health_task = None
+        self.metrics = {}
     
 
     async def connect(self) -> None:
-        self.chroma_client = await chromadb.AsyncHttpClient(
-                    settings=Settings(chroma_api_impl="rest",
-                            chroma_server_host="localhost",
-                            chroma_server_http_port=8000)
-                    )
-        
-        self.collection = await self.chroma_client.get_or_create_collection(name="prod")
+        if self.backend == "local":
+            self.chroma_client = LocalClient(PERSIST_DIRECTORY)
+        else:
+            self.chroma_client = await chromadb.AsyncHttpClient(host=self.host, port=self.port)
         
+        self.collection = await self.chroma_client.get_or_create_collection(name=self.collection_name)
+
+
+    async def ensure_connected(self) -> None:
+        # concurrent first requests share one connect
+        if self.collection is None:
+            async with self.connect_lock:
+                if self.collection is None:
+                    await self.connect()
 
-    
 
-    async def add_to_vector_store(self, chunks: list, metadatas: list=[]) -> None:
-        if not self.chroma_client:
+    async def reconnect(self) -> None:
+        async with self.connect_lock:
+            self.chroma_client = None
+            self.collection = None
             await self.connect()
-        
-        with open("embedding_id.txt", "r") as f:
-            last_used_id = int(f.readline())
-        
-        with open("embedding_id.txt", "w") as f:
-            f.write(str(last_used_id+len(chunks)))
 
 
-        ids = list(range(last_used_id, last_used_id+len(chunks)))
-        ids = list(map(str, ids))
+    async def health_check(self) -> bool:
+        try:
+            await self.ensure_connected()
+            await self.chroma_client.heartbeat()
+            return True
+        except Exception as e:
+            print(f"chroma health check failed ({e}), reconnecting")
+            try:
+                await self.reconnect()
+                return True
+            except Exception as e:
+                print(f"chroma reconnect failed: {e}")
+                return False
+
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(CHROMA_HEALTH_CHECK_INTERVAL)
+            await self.health_check()
+
+
+    async def start(self) -> None:
+        # app startup: connect early and keep checking the connection in the background
+        if not await self.health_check():
+            print(f"chroma at {self.host}:{self.port} is not reachable yet, will retry")
+        # a local collection has no connection to lose
+        if self.backend == "local":
+            return
+        self.health_task = asyncio.create_task(self._health_loop())
+
+
+    async def close(self) -> None:
+        if self.health_task:
+            self.health_task.cancel()
+            self.health_task = None
+        self.chroma_client = None
+        self.collection = None
+
+
+    async def _run(self, operation: str, call):
+        # call() runs against the current collection, a dropped connection is retried once on a fresh client
+        await self.ensure_connected()
+        metrics = self.metrics.setdefault(operation, OperationMetrics())
+        start = time.perf_counter()
+        try:
+            try:
+                result = await call()
+            except CONNECTION_ERRORS:
+                await self.reconnect()
+                result = await call()
+        except Exception:
+            metrics.record((time.perf_counter() - start) * 1000, failed=True)
+            raise
+        metrics.record((time.perf_counter() - start) * 1000)
+        return result
+
+
+    def latency_metrics(self) -> dict:
+        return {operation: metrics.summary() for operation, metrics in self.metrics.items()}
+
+    
+
+    async def add_to_vector_store(self, chunks: list, metadatas: list=[], ids: list=None, progress=None) -> list:
+        # any number of chunks, written in batches through a BatchUpserter; progress(stored) is called after each batch
+        if not chunks:
+            return []
 
         if not metadatas:
             metadatas = [{"test":True}]*len(chunks)
 
-        
-        await self.collection.add(documents=chunks, metadatas=metadatas, ids=ids)
+        # chunks of an ingested document get their content-derived id, anything else a random one
+        if ids is None:
+            ids = [metadata_chunk_id(metadata) or str(uuid.uuid4()) for metadata in metadatas]
 
+        upserter = BatchUpserter(self, progress=progress)
+        await upserter.add(chunks, metadatas, ids)
+        await upserter.flush()
+        return ids
 
 
-    async def query_vector_store(self, query: str, metadata=None, n_results=3) -> list:
-        if not self.chroma_client:
-            await self.connect()
 
-        result = await self.collection.query(query_texts=[query], where=metadata, n_results=n_results)
-        
+    async def upsert_batch(self, chunks: list, metadatas: list, ids: list) -> None:
+        embeddings = await get_embedding_service().embed_documents(chunks)
+
+        # upsert, so retrying a batch after a failure can't duplicate or collide
+        await self._run("add", lambda: self.collection.upsert(documents=chunks, metadatas=metadatas, embeddings=embeddings, ids=ids))
+        get_bm25_index().add(ids, chunks, metadatas)
+        # journaled per batch, an ingestion that stops part way keeps what it stored searchable
+        await asyncio.to_thread(get_bm25_index().save)
+
+
+
+    async def get_document_chunks(self, doc_name: str) -> dict:
+        # ids and metadatas of every chunk stored for a document, documents and embeddings are left out
+        return await self._run("get", lambda: self.collection.get(where={"doc_name": doc_name}, include=["metadatas"]))
+
+
+
+    async def update_metadata(self, ids: list, metadatas: list) -> None:
+        for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+            batch_ids, batch_metadatas = ids[start:start + UPSERT_BATCH_SIZE], metadatas[start:start + UPSERT_BATCH_SIZE]
+            await self._run("update", lambda: self.collection.update(ids=batch_ids, metadatas=batch_metadatas))
+            get_bm25_index().update(batch_ids, batch_metadatas)
+        await asyncio.to_thread(get_bm25_index().save)
+
+
+
+    async def query_vector_store(self, query: str, metadata=None, n_results=3, include=("metadatas", "documents", "distances")) -> list:
+        query_embedding = await get_embedding_service().embed_query(query)
+        return await self._run("query", lambda: self.collection.query(query_embeddings=[query_embedding], where=metadata, n_results=n_results, include=list(include)))
+
+
+
+    async def hybrid_query(self, query: str, n_results=3, fetch_k=HYBRID_FETCH_K, where: dict = None, include_embeddings: bool = False) -> dict:
+        """
+        Vector and BM25 search run concurrently, their rankings are merged with reciprocal rank fusion.
+        Exact identifiers (clause numbers, form codes, acronyms) are found by BM25 even when the embedding misses them.
+        where (see scope_filter) restricts both searches. Returns a query_vector_store shaped result.
+        """
+        include = ["documents", "metadatas"] + (["embeddings"] if include_embeddings else [])
+        dense, keyword = await asyncio.gather(
+            self.query_vector_store(query=query, metadata=where, n_results=fetch_k, include=include),
+            asyncio.to_thread(get_bm25_index().search, query, fetch_k, where),
+        )
+        found = {id: (dense["documents"][0][i], dense["metadatas"][0][i], dense["embeddings"][0][i] if include_embeddings else None)
+                 for i, id in enumerate(dense["ids"][0])}
+        fused = reciprocal_rank_fusion([dense["ids"][0], [id for id, _ in keyword]])[:n_results]
+
+        # keyword hits the vector search did not return
+        missing = [id for id, _ in fused if id not in found]
+        if missing:
+            stored = await self._run("get", lambda: self.collection.get(ids=missing, include=include))
+            found.update({id: (stored["documents"][i], stored["metadatas"][i], stored["embeddings"][i] if include_embeddings else None)
+                          for i, id in enumerate(stored["ids"])})
+
+        fused = [(id, score) for id, score in fused if id in found]
+        result = {
+            "ids": [[id for id, _ in fused]],
+            "documents": [[found[id][0] for id, _ in fused]],
+            "metadatas": [[found[id][1] for id, _ in fused]],
+            "scores": [[score for _, score in fused]],
+        }
+        if include_embeddings:
+            result["embeddings"] = [[found[id][2] for id, _ in fused]]
         return result
-    
 
 
 
-    async def delete_from_vector_store(self, doc_name: str, ids: list) -> None:
-        if not self.chroma_client:
-            await self.connect()
+    async def retrieve(self, query: str, n_results=3, where: dict = None, fetch_k=MMR_FETCH_K, lambda_mult=MMR_LAMBDA) -> dict:
+        """
+        Chunks for answering query: fetch_k hybrid candidates, of which n_results are picked by
+        maximal marginal relevance so near-duplicate neighbour chunks don't fill the context.
+        The re-ranking time is recorded as the "mmr" operation in latency_metrics().
+        """
+        candidates = await self.hybrid_query(query, n_results=max(fetch_k, n_results), where=where, include_embeddings=True)
+        if len(candidates["ids"][0]) <= n_results:
+            candidates.pop("embeddings")
+            return candidates
+
+        query_embedding = await get_embedding_service().embed_query(query)
+        start = time.perf_counter()
+        picked = mmr(query_embedding, candidates["embeddings"][0], n_results, lambda_mult)
+        self.metrics.setdefault("mmr", OperationMetrics()).record((time.perf_counter() - start) * 1000)
+
+        return {field: [[values[0][i] for i in picked]] for field, values in candidates.items() if field != "embeddings"}
+    
 
 
+
+    async def delete_from_vector_store(self, doc_name: str=None, ids: list=None) -> None:
         if doc_name:
-            await self.collection.delete(where={"doc_name": doc_name})
+            await self._run("delete", lambda: self.collection.delete(where={"doc_name": doc_name}))
+            get_bm25_index().remove_document(doc_name)
+            await asyncio.to_thread(get_answer_cache().invalidate, doc_names=[doc_name])
         
         elif ids:
-            await self.collection.delete(ids=ids)
+            for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+                batch_ids = ids[start:start + UPSERT_BATCH_SIZE]
+                await self._run("delete", lambda: self.collection.delete(ids=batch_ids))
+                get_bm25_index().remove(batch_ids)
+            await asyncio.to_thread(get_answer_cache().invalidate, chunk_ids=ids)
+        # otherwise the deleted chunks come back with the saved index after a restart
+        await asyncio.to_thread(get_bm25_index().save)
+
+
+
+    async def migrate_numeric_ids(self) -> int:
+        """
+        Moves chunks stored under the old sequential ids from embedding_id.txt to content-derived ids.
+        Embeddings are copied, nothing is re-embedded. Chunks without document metadata become "legacy-<old id>".
+        Safe to run again after an interruption. Returns how many chunks were moved.
+        """
+        stored = await self._run("get", lambda: self.collection.get(include=[]))
+        numeric_ids = [id for id in stored["ids"] if id.isdigit()]
+
+        for start in range(0, len(numeric_ids), MIGRATION_BATCH_SIZE):
+            batch_ids = numeric_ids[start:start + MIGRATION_BATCH_SIZE]
+            batch = await self._run("get", lambda: self.collection.get(ids=batch_ids, include=["documents", "metadatas", "embeddings"]))
+            new_ids = [metadata_chunk_id(metadata) or f"legacy-{id}" for id, metadata in zip(batch["ids"], batch["metadatas"])]
+
+            # copy first, then delete, so an interrupted run loses nothing
+            await self._run("add", lambda: self.collection.upsert(ids=new_ids, documents=batch["documents"], metadatas=batch["metadatas"], embeddings=batch["embeddings"]))
+            await self._run("delete", lambda: self.collection.delete(ids=batch["ids"]))
+            print(f"migrated {start + len(batch_ids)}/{len(numeric_ids)} chunks")
+
+        return len(numeric_ids)
         
     
 
+class BatchUpserter:
+    """
+    Streams chunks into the store as they are produced: they are written in batches of batch_size,
+    at most max_in_flight batches at a time, and add() waits while that many are in flight, so a
+    producer can't run ahead of the store and memory stays bounded however long the document is.
+    A failed batch is retried on its own; when it still fails, the next add() or flush() raises.
+    """
+
+    def __init__(self, vector_db: VectorDatabase, batch_size: int = UPSERT_BATCH_SIZE, max_in_flight: int = UPSERT_MAX_IN_FLIGHT,
+                 retries: int = UPSERT_RETRIES, progress=None) -> None:
+        self.vector_db = vector_db
+        self.batch_size = batch_size
+        self.retries = retries
+        self.progress = progress
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.buffer = []
+        self.tasks = set()
+        self.error = None
+        self.stored = 0
+        self.failed_attempts = 0
+
+
+    async def add(self, chunks: list, metadatas: list, ids: list = None) -> None:
+        if self.error:
+            raise self.error
+        if ids is None:
+            ids = [metadata_chunk_id(metadata) or str(uuid.uuid4()) for metadata in metadatas]
+        self.buffer.extend(zip(chunks, metadatas, ids))
+        while len(self.buffer) >= self.batch_size:
+            batch, self.buffer = self.buffer[:self.batch_size], self.buffer[self.batch_size:]
+            await self._start(batch)
+
+
+    async def _start(self, batch: list) -> None:
+        await self.slots.acquire()
+        task = asyncio.create_task(self._write(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+    async def _write(self, batch: list) -> None:
+        chunks, metadatas, ids = (list(column) for column in zip(*batch))
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    await self.vector_db.upsert_batch(chunks, metadatas, ids)
+                    break
+                except Exception as e:
+                    self.failed_attempts += 1
+                    if attempt == self.retries:
+                        self.error = self.error or e
+                        return
+                    print(f"upserting {len(batch)} chunks failed ({e}), retrying")
+                    await asyncio.sleep(UPSERT_RETRY_DELAY * 2 ** attempt)
+
+            self.stored += len(batch)
+            if self.progress:
+                self.progress(self.stored)
+        finally:
+            self.slots.release()
+
+
+    async def flush(self) -> int:
+        # writes what is buffered, waits for every batch and returns how many chunks were stored
+        if self.buffer and not self.error:
+            batch, self.buffer = self.buffer, []
+            await self._start(batch)
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.error:
+            raise self.error
+        return self.stored
+
+
+    def cancel(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+
+
+_vector_db = None
+
+def get_vector_db() -> VectorDatabase:
+    global _vector_db
+    if _vector_db is None:
+        _vector_db = VectorDatabase()
+    return _vector_db
+
 
 # Example Usage
 async def main():
@@ -103,5 +642,14 @@ async def main():
         print(result)
 
 
+async def migrate():
+    moved = await get_vector_db().migrate_numeric_ids()
+    print(f"moved {moved} chunks to content-derived ids, embedding_id.txt is no longer used")
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # python -m Rag.vector_db migrate-ids
+    if sys.argv[1:] == ["migrate-ids"]:
+        asyncio.run(migrate())
+    else:
+        asyncio.run(main())
\ No newline at end of file
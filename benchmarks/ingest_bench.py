@@ -0,0 +1,196 @@
+"""
+End-to-end ingestion benchmark: extract -> summarize -> chunk -> header -> embed through
+Rag.model.add_document, against a local fake Groq server and an in-process fake chroma collection.
+
+    python -m benchmarks.ingest_bench --kinds text scanned mixed --pages 5 50 --output bench.json
+
+Every scenario runs in its own process with cold caches, so peak RSS is per scenario.
+Stage times are busy time summed over calls, stages overlap so they can add up to more than wall time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is in KiB on linux, children covers the OCR worker processes
+    return {
+        "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "largest_child": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+class StageTimer:
+    def __init__(self) -> None:
+        self.busy = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.busy[name] = self.busy.get(name, 0.0) + time.perf_counter() - start
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+
+    def wrap(self, name: str, function):
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed
+
+
+    def wrap_async(self, name: str, function):
+        async def timed(*args, **kwargs):
+            with self.stage(name):
+                return await function(*args, **kwargs)
+        return timed
+
+
+    def wrap_iterator(self, name: str, function):
+        def timed(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            while True:
+                with self.stage(name):
+                    item = next(iterator, None)
+                if item is None:
+                    return
+                yield item
+        return timed
+
+
+def run_scenario(kind: str, pages: int, llm_latency: float, embeddings: str) -> dict:
+    from benchmarks.standins import FakeCollection, FakeGroqServer, HashingEmbeddingFunction
+    from benchmarks.synthetic_pdfs import generate_pdf
+
+    # the scenario runs in a scratch directory, keep the repo importable from there
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    workdir = tempfile.mkdtemp(prefix="ingest_bench_")
+    server = FakeGroqServer(latency=llm_latency).start()
+
+    # everything the Rag modules read at import time has to be set first
+    os.environ.update({
+        "GROQ_BASE_URL": server.url,
+        "GROQ_API_BASE": server.url,
+        "GROQ_API_KEYS_str": "bench-key-1,bench-key-2,bench-key-3",
+        "GROQ_REQUESTS_PER_MINUTE": "1000000",
+        "GROQ_TOKENS_PER_MINUTE": "100000000",
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.sqlite3"),
+        "OCR_CACHE_PATH": os.path.join(workdir, "ocr_cache.sqlite3"),
+        "BM25_INDEX_PATH": os.path.join(workdir, "bm25_index.pickle"),
+        "ANSWER_CACHE_PATH": os.path.join(workdir, "answer_cache.sqlite3"),
+    })
+    os.chdir(workdir)
+    os.makedirs("summaries", exist_ok=True)
+
+    pdf_path = os.path.join(workdir, f"{kind}_{pages}.pdf")
+    generate_pdf(pdf_path, kind, pages)
+
+    import Rag.model as model
+    from Rag.chunker import StreamingChunker, get_token_offsets
+    from Rag.vector_db import VectorDatabase, get_embedding_service, load_embedding_function
+
+    collection = FakeCollection()
+
+    async def connect(self):
+        self.chroma_client = collection
+        self.collection = collection
+
+    timer = StageTimer()
+    VectorDatabase.connect = connect
+    VectorDatabase.upsert_batch = timer.wrap_async("embed", VectorDatabase.upsert_batch)
+    StreamingChunker.add_page = timer.wrap("chunk", StreamingChunker.add_page)
+    StreamingChunker.finish = timer.wrap("chunk", StreamingChunker.finish)
+    model.iter_document_pages = timer.wrap_iterator("extract", model.iter_document_pages)
+    model.summarize = timer.wrap_async("summarize", model.summarize)
+    model.add_chunk_headers = timer.wrap_async("header", model.add_chunk_headers)
+
+    # loading the tokenizer is a once per process cost, keep it out of the measured run
+    start = time.perf_counter()
+    get_token_offsets()
+    tokenizer_load = time.perf_counter() - start
+
+    # same for the embedding model, "hashing" needs no model download
+    start = time.perf_counter()
+    embedding_service = get_embedding_service()
+    embedding_service.embedding_function = HashingEmbeddingFunction() if embeddings == "hashing" else load_embedding_function()
+    embedding_service.embedding_function(["warm up"])
+    embedding_load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = asyncio.run(model.add_document(file_path=pdf_path, file_name=os.path.basename(pdf_path)))
+    wall = time.perf_counter() - start
+    server.stop()
+
+    return {
+        "kind": kind,
+        "pages": pages,
+        "wall_seconds": round(wall, 4),
+        "tokenizer_load_seconds": round(tokenizer_load, 4),
+        "embeddings": embeddings,
+        "embedding_load_seconds": round(embedding_load, 4),
+        "stage_busy_seconds": {name: round(seconds, 4) for name, seconds in timer.busy.items()},
+        "stage_calls": timer.calls,
+        "pages_per_second": round(pages / wall, 3),
+        "chunks_per_second": round(stats["chunks"] / wall, 3),
+        "llm_calls": server.calls,
+        "llm_calls_total": sum(server.calls.values()),
+        "peak_rss_mb": peak_rss_mb(),
+        "ingest_stats": stats,
+        "embedding_stats": embedding_service.stats(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kinds", nargs="+", default=["text", "scanned", "mixed"], choices=["text", "scanned", "mixed"])
+    parser.add_argument("--pages", nargs="+", type=int, default=[5, 50])
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds the fake Groq server takes per request")
+    parser.add_argument("--embeddings", default="onnx", choices=["onnx", "hashing"],
+                        help="onnx runs the real embedding model on CPU, hashing is an offline stand-in")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--scenario", nargs=2, metavar=("KIND", "PAGES"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        # child process: one scenario, result as JSON on the last line of stdout
+        print(json.dumps(run_scenario(args.scenario[0], int(args.scenario[1]), args.llm_latency, args.embeddings)))
+        return
+
+    results = []
+    for kind in args.kinds:
+        for pages in args.pages:
+            child = subprocess.run(
+                [sys.executable, "-m", "benchmarks.ingest_bench", "--scenario", kind, str(pages), "--llm-latency", str(args.llm_latency),
+                 "--embeddings", args.embeddings],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            )
+            if child.returncode != 0:
+                results.append({"kind": kind, "pages": pages, "error": child.stderr.strip().splitlines()[-1:]})
+            else:
+                results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+            print(f"{kind} x {pages} pages done", file=sys.stderr)
+
+    report = json.dumps({"created": time.time(), "scenarios": results}, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
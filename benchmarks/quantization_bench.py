@@ -0,0 +1,99 @@
+"""
+Memory against recall of the local vector index at float32, float16 and int8 precision.
+The corpus is the ingestion benchmark's synthetic policy text, chunked like add_document does;
+recall@k is measured against an exact float32 search, with and without full-precision re-scoring.
+
+    python -m benchmarks.quantization_bench --pages 2000 --queries 200 --k 3 10
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import numpy as np
+
+
+def corpus_chunks(pages: int) -> list:
+    from benchmarks.synthetic_pdfs import corpus_pages
+    from Rag.chunker import split_pages
+
+    return [chunk["text"] for chunk in split_pages((number, "\n".join(lines)) for number, lines in enumerate(corpus_pages(pages), start=1))]
+
+
+def queries(count: int) -> list:
+    import random
+    from benchmarks.synthetic_pdfs import policy_sentence
+
+    rng = random.Random(1)
+    return [policy_sentence(rng) for _ in range(count)]
+
+
+def run(args) -> dict:
+    from benchmarks.standins import HashingEmbeddingFunction
+    from Rag.local_index import LocalCollection, normalize
+    from Rag.vector_db import load_embedding_function
+
+    embedding_function = HashingEmbeddingFunction() if args.embeddings == "hashing" else load_embedding_function()
+    chunks = corpus_chunks(args.pages)
+    print(f"{len(chunks)} chunks", file=sys.stderr)
+    vectors = normalize(embedding_function(chunks))
+    query_vectors = normalize(embedding_function(queries(args.queries)))
+
+    # ground truth: exact float32 search
+    k_max = max(args.k)
+    exact = np.argsort(-(query_vectors @ vectors.T), axis=1)[:, :k_max]
+
+    results = []
+    for precision in ("float32", "float16", "int8"):
+        collection = LocalCollection(tempfile.mkdtemp(prefix="quantization_bench_"), "bench", precision=precision)
+        for start in range(0, len(chunks), 1000):
+            collection._upsert([str(i) for i in range(start, min(start + 1000, len(chunks)))], embeddings=vectors[start:start + 1000])
+
+        for rescore in ([1] if precision == "float32" else [1, args.rescore]):
+            collection.rescore = rescore
+            recall = {k: [] for k in args.k}
+            latencies = []
+            for query, truth in zip(query_vectors, exact):
+                start = time.perf_counter()
+                found = collection._query([query], n_results=k_max, include=[])["ids"][0]
+                latencies.append((time.perf_counter() - start) * 1000)
+                for k in args.k:
+                    recall[k].append(len({int(id) for id in found[:k]} & set(truth[:k].tolist())) / k)
+
+            memory = collection.memory_stats()
+            latencies.sort()
+            results.append({
+                "precision": precision,
+                "rescore": rescore,
+                "scan_mb": round(memory["scan_bytes"] / 2**20, 3),
+                "memory_saved": round(1 - memory["scan_bytes"] / memory["float32_bytes"], 3),
+                **{f"recall@{k}": round(float(np.mean(values)), 4) for k, values in recall.items()},
+                "p50_ms": round(latencies[len(latencies) // 2], 3),
+                "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3),
+            })
+            print(f"{precision} rescore={rescore} done", file=sys.stderr)
+
+    return {"created": time.time(), "embeddings": args.embeddings, "chunks": len(chunks), "dimensions": int(vectors.shape[1]),
+            "queries": args.queries, "results": results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", nargs="+", type=int, default=[3, 10])
+    parser.add_argument("--rescore", type=int, default=4, help="shortlist multiplier for the re-scored runs")
+    parser.add_argument("--embeddings", default="hashing", choices=["onnx", "hashing"])
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Query latency of the vector backends: the chroma HTTP server and the in-process local index.
+Both get the same synthetic chunks and the same queries; p50/p99 cover the store call only,
+query embeddings are computed up front.
+
+    python -m benchmarks.query_latency_bench --chunks 10000 --queries 500 --backends http local
+
+The http backend needs a chroma server at CHROMA_HOST:CHROMA_PORT, e.g. `chroma run --path /tmp/chroma`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def synthetic_chunks(count: int, seed: int = 0) -> list:
+    from benchmarks.synthetic_pdfs import policy_sentence
+
+    rng = random.Random(seed)
+    return [" ".join(policy_sentence(rng) for _ in range(6)) for _ in range(count)]
+
+
+def percentiles(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        "p50_ms": round(samples[len(samples) // 2], 3),
+        "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+        "mean_ms": round(sum(samples) / len(samples), 3),
+    }
+
+
+async def run_backend(backend: str, chunks: list, embeddings: list, query_embeddings: list, n_results: int, insert_batch: int) -> dict:
+    from Rag.vector_db import VectorDatabase
+
+    collection_name = f"latency_bench_{int(time.time())}"
+    db = VectorDatabase(collection_name=collection_name, backend=backend)
+    await db.ensure_connected()
+
+    start = time.perf_counter()
+    for i in range(0, len(chunks), insert_batch):
+        ids = [f"chunk-{j}" for j in range(i, min(i + insert_batch, len(chunks)))]
+        await db.collection.upsert(ids=ids, documents=chunks[i:i + insert_batch], embeddings=embeddings[i:i + insert_batch],
+                                   metadatas=[{"doc_name": f"doc-{j % 20}"} for j in range(i, i + len(ids))])
+    insert_seconds = time.perf_counter() - start
+
+    # a few queries to warm up connections and caches
+    for query_embedding in query_embeddings[:10]:
+        await db.collection.query(query_embeddings=[query_embedding], n_results=n_results)
+
+    samples = []
+    for query_embedding in query_embeddings:
+        start = time.perf_counter()
+        await db.collection.query(query_embeddings=[query_embedding], n_results=n_results)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    if backend == "http":
+        await db.chroma_client.delete_collection(collection_name)
+    return {"backend": backend, "chunks": len(chunks), "insert_seconds": round(insert_seconds, 3), **percentiles(samples)}
+
+
+async def run(args) -> dict:
+    from benchmarks.standins import HashingEmbeddingFunction
+    from Rag.vector_db import load_embedding_function
+
+    embedding_function = HashingEmbeddingFunction() if args.embeddings == "hashing" else load_embedding_function()
+    chunks = synthetic_chunks(args.chunks)
+    queries = synthetic_chunks(args.queries, seed=1)
+    embeddings = [[float(value) for value in vector] for vector in embedding_function(chunks)]
+    query_embeddings = [[float(value) for value in vector] for vector in embedding_function(queries)]
+
+    results = []
+    for backend in args.backends:
+        try:
+            results.append(await run_backend(backend, chunks, embeddings, query_embeddings, args.n_results, args.insert_batch))
+        except Exception as e:
+            results.append({"backend": backend, "error": f"{type(e).__name__}: {e}"})
+        print(f"{backend} done", file=sys.stderr)
+    return {"created": time.time(), "embeddings": args.embeddings, "n_results": args.n_results, "queries": args.queries, "backends": results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["http", "local"], choices=["http", "local"])
+    parser.add_argument("--chunks", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--n-results", type=int, default=3)
+    parser.add_argument("--insert-batch", type=int, default=500)
+    parser.add_argument("--embeddings", default="hashing", choices=["onnx", "hashing"])
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    # the local backend writes into a scratch directory, never into the app's PERSIST_DIRECTORY
+    os.environ["PERSIST_DIRECTORY"] = tempfile.mkdtemp(prefix="query_latency_bench_")
+    os.environ["BM25_INDEX_PATH"] = os.path.join(os.environ["PERSIST_DIRECTORY"], "bm25_index.pickle")
+    os.environ["ANSWER_CACHE_PATH"] = os.path.join(os.environ["PERSIST_DIRECTORY"], "answer_cache.sqlite3")
+
+    report = json.dumps(asyncio.run(run(args)), indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
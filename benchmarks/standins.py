@@ -0,0 +1,256 @@
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Rag.local_index import matches
+
+
+RATE_LIMIT_HEADERS = {
+    "x-ratelimit-limit-requests": "1000000",
+    "x-ratelimit-limit-tokens": "100000000",
+    "x-ratelimit-remaining-requests": "1000000",
+    "x-ratelimit-remaining-tokens": "100000000",
+}
+
+
+def classify_request(messages: list) -> str:
+    system = " ".join(message["content"] for message in messages if message["role"] == "system")
+    if "numbered chunks" in system:
+        return "batched_header"
+    if "chunk of text" in system:
+        return "header"
+    if "summarizes" in system:
+        return "summary"
+    return "chat"
+
+
+def fake_completion(messages: list) -> str:
+    kind = classify_request(messages)
+    if kind == "batched_header":
+        count = len(re.findall(r"^CHUNK \d+:", messages[-1]["content"], re.M))
+        return json.dumps([{"chunk": i + 1, "title": "Synthetic section", "summary": "policy provisions for employees"} for i in range(count)])
+    if kind == "header":
+        return "Title: Synthetic section\nSummary: policy provisions for employees\n"
+    if kind == "summary":
+        return "The document lists synthetic policy provisions."
+    return "Employees shall submit the leave application within 7 days through the ERP portal."
+
+
+def completion_usage(body: dict, content: str) -> dict:
+    prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+    completion_tokens = len(re.findall(r"\S+", content))
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 256
+
+
+class FakeGroqServer:
+    """
+    Local stand-in for the Groq chat completions API (plain and streamed), with a fixed
+    latency per request and per streamed token. Counts requests by what they were for.
+    Point the clients at it with GROQ_BASE_URL / GROQ_API_BASE = server.url.
+    With tokens_per_minute the x-ratelimit-* headers report each API key's actual use in the
+    last minute against that limit, otherwise an effectively unlimited plan.
+    """
+
+    def __init__(self, latency: float = 0.05, token_latency: float = 0.01, port: int = 0,
+                 tokens_per_minute: int = None, requests_per_minute: int = None) -> None:
+        self.latency = latency
+        self.token_latency = token_latency
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.calls = {}
+        # (time, tokens) of every answered request in the last minute, per API key
+        self.usage = {}
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server.lock:
+                    kind = classify_request(body["messages"])
+                    server.calls[kind] = server.calls.get(kind, 0) + 1
+
+                time.sleep(server.latency)
+                content = fake_completion(body["messages"])
+                if body.get("stream"):
+                    try:
+                        self.stream(body, content)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # the client stopped reading, a cancelled stream
+                        self.close_connection = True
+                else:
+                    self.respond(body, content)
+
+            def send_common_headers(self, content_type, usage):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                for name, value in server.rate_limit_headers(self.headers.get("Authorization", ""), usage["total_tokens"]).items():
+                    self.send_header(name, value)
+
+            def respond(self, body, content):
+                usage = completion_usage(body, content)
+                payload = json.dumps({
+                    "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": usage,
+                }).encode()
+                self.send_common_headers("application/json", usage)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def stream(self, body, content):
+                usage = completion_usage(body, content)
+                self.send_common_headers("text/event-stream", usage)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def send(data):
+                    event = f"data: {data}\n\n".encode()
+                    self.wfile.write(f"{len(event):X}\r\n".encode() + event + b"\r\n")
+                    self.wfile.flush()
+
+                for word in re.findall(r"\S+\s*", content):
+                    time.sleep(server.token_latency)
+                    send(json.dumps({
+                        "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"],
+                        "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+                    }))
+                # like groq, the usage comes with the last chunk
+                send(json.dumps({
+                    "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"],
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                    "x_groq": {"id": "fake", "usage": usage},
+                }))
+                send("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.httpd = FakeHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+
+    def rate_limit_headers(self, authorization: str, tokens: int) -> dict:
+        if self.tokens_per_minute is None:
+            return RATE_LIMIT_HEADERS
+        now = time.monotonic()
+        with self.lock:
+            used = self.usage.setdefault(authorization, deque())
+            used.append((now, tokens))
+            while used and used[0][0] < now - 60:
+                used.popleft()
+            return {
+                "x-ratelimit-limit-requests": str(self.requests_per_minute or 1000000),
+                "x-ratelimit-limit-tokens": str(self.tokens_per_minute),
+                "x-ratelimit-remaining-requests": "1000000",
+                "x-ratelimit-remaining-tokens": str(max(0, self.tokens_per_minute - sum(amount for _, amount in used))),
+            }
+
+
+    def start(self) -> "FakeGroqServer":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+
+class HashingEmbeddingFunction:
+    """
+    Offline stand-in for the embedding model: hashed bag of words, L2-normalized. Texts that
+    share words get similar vectors, which is all retrieval needs to be exercised.
+    """
+
+    def __init__(self, dimensions: int = 384) -> None:
+        self.dimensions = dimensions
+
+
+    def __call__(self, texts: list) -> list:
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.md5(word.encode()).digest()
+                vector[int.from_bytes(digest[:4], "little") % self.dimensions] += 1.0 if digest[4] & 1 else -1.0
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            vectors.append([value / norm for value in vector])
+        return vectors
+
+
+class FakeCollection:
+    """
+    In-process stand-in for a chroma AsyncCollection. Queries rank by cosine distance when
+    embeddings are given and by shared words otherwise, enough to drive the pipeline without a chroma server.
+    """
+
+    def __init__(self) -> None:
+        self.records = {}
+
+
+    async def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        for i, id in enumerate(ids):
+            self.records[id] = {"document": documents[i] if documents else None,
+                                "metadata": metadatas[i] if metadatas else None,
+                                "embedding": embeddings[i] if embeddings is not None else None}
+
+    upsert = add
+
+
+    async def update(self, ids, metadatas=None, documents=None, embeddings=None):
+        for i, id in enumerate(ids):
+            if metadatas:
+                self.records[id]["metadata"] = metadatas[i]
+
+
+    async def get(self, ids=None, where=None, include=("metadatas", "documents"), limit=None, offset=None):
+        selected = [id for id in (ids if ids is not None else self.records) if id in self.records and matches(self.records[id]["metadata"], where)]
+        if offset or limit:
+            selected = selected[offset or 0:(offset or 0) + limit if limit else None]
+        result = {"ids": selected}
+        for field, key in (("documents", "document"), ("metadatas", "metadata"), ("embeddings", "embedding")):
+            result[field] = [self.records[id][key] for id in selected] if field in include else None
+        return result
+
+
+    async def delete(self, ids=None, where=None):
+        for id in [id for id in (ids if ids is not None else list(self.records)) if id in self.records]:
+            if matches(self.records[id]["metadata"], where):
+                del self.records[id]
+
+
+    async def count(self):
+        return len(self.records)
+
+
+    async def query(self, query_texts=None, query_embeddings=None, n_results=10, where=None, include=("metadatas", "documents", "distances")):
+        words = set(re.findall(r"\w+", (query_texts or [""])[0].lower()))
+        scored = []
+        for id, record in self.records.items():
+            if matches(record["metadata"], where):
+                if query_embeddings is not None and record["embedding"] is not None:
+                    # cosine distance, the embeddings are normalized
+                    scored.append((1.0 - sum(q * d for q, d in zip(query_embeddings[0], record["embedding"])), id))
+                    continue
+                overlap = len(words & set(re.findall(r"\w+", (record["document"] or "").lower())))
+                scored.append((1.0 - overlap / (len(words) or 1), id))
+        scored.sort()
+        top = scored[:n_results]
+        result = {"ids": [[id for _, id in top]], "distances": [[distance for distance, _ in top]]}
+        for field, key in (("documents", "document"), ("metadatas", "metadata"), ("embeddings", "embedding")):
+            result[field] = [[self.records[id][key] for _, id in top]] if field in include else None
+        return result
@@ -0,0 +1,192 @@
+"""
+Many answers streamed at once. Every stream asks the fake streaming Groq server for a completion
+and records when its first and last token arrived; if the streams make progress together, the
+wall time stays near one stream's duration instead of their sum.
+
+    python -m benchmarks.stream_concurrency_bench --streams 50 --implementations async blocking
+
+runs the streams in this process: "async" is Rag.streaming (what stream_generate_async uses),
+"blocking" the previous implementation that iterated a sync Groq stream on the event loop.
+A probe task reports how long the event loop was stalled.
+
+    python -m benchmarks.stream_concurrency_bench --target askpdf --url ws://127.0.0.1:8080/askpdf --fake-port 8765
+
+drives /askpdf of a running app instead, each stream with an attached synthetic PDF. Start the
+app against the fake server first:
+GROQ_BASE_URL=http://127.0.0.1:8765 GROQ_API_KEYS_str=bench-key-1,bench-key-2,bench-key-3 uvicorn main:app --port 8080
+
+Both run at the key scheduler's configured per-key limits (GROQ_REQUESTS_PER_MINUTE,
+GROQ_TOKENS_PER_MINUTE), and the fake server reports each key's use against them in its
+rate-limit headers, so the numbers include waiting for key capacity.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+MESSAGES = [{"role": "user", "content": "How many days do employees have to submit a leave application?"}]
+
+
+def percentile(samples: list, p: float):
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(p * len(samples)))], 3) if samples else None
+
+
+def summarize(name: str, streams: list, wall: float) -> dict:
+    # streams: (started, first_token, finished) perf_counter times, first_token None when nothing arrived
+    first_tokens = [(first - started) * 1000 for started, first, _ in streams if first is not None]
+    durations = [(finished - started) * 1000 for started, _, finished in streams]
+    # most streams that were between their first and last token at the same moment
+    events = sorted([(first, 1) for _, first, _ in streams if first is not None] + [(finished, -1) for _, first, finished in streams if first is not None])
+    overlapping = peak = 0
+    for _, change in events:
+        overlapping += change
+        peak = max(peak, overlapping)
+    return {
+        "implementation": name,
+        "streams": len(streams),
+        "wall_seconds": round(wall, 3),
+        "serial_seconds": round(sum(durations) / 1000, 3),
+        "time_to_first_token_p50_ms": percentile(first_tokens, 0.50),
+        "time_to_first_token_p99_ms": percentile(first_tokens, 0.99),
+        "stream_p50_ms": percentile(durations, 0.50),
+        "peak_streams_in_progress": peak,
+    }
+
+
+async def loop_probe(stop: asyncio.Event, interval: float = 0.01) -> float:
+    # longest time the loop took to come back to a task that only sleeps
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def blocking_stream(messages: list):
+    # the previous stream_generate_async: the stream is opened in a thread, then read on the event loop
+    from groq import Groq
+    from Rag.groq_keys import get_key_scheduler
+
+    def create(api_key):
+        return Groq(api_key=api_key).chat.completions.with_raw_response.create(model="llama-3.1-8b-instant", messages=messages, max_tokens=1024, stream=True)
+
+    completion = (await get_key_scheduler().arun(lambda api_key: asyncio.to_thread(create, api_key), 1024)).parse()
+    for chunk in completion:
+        yield chunk.choices[0].delta.content or ""
+        await asyncio.sleep(0)
+
+
+async def async_stream(messages: list):
+    from Rag.streaming import stream_chat_completion
+
+    async for text in stream_chat_completion(messages, model="llama-3.1-8b-instant", max_tokens=1024):
+        yield text
+
+
+async def run_direct(implementation: str, count: int) -> dict:
+    # module imports and client set-up are a once per process cost, keep them out of the measured run
+    import groq
+    from Rag.clients import get_client_registry
+    from Rag.groq_keys import get_key_scheduler
+    import Rag.streaming
+
+    get_client_registry().start(list(get_key_scheduler().states))
+    stream_function = async_stream if implementation == "async" else blocking_stream
+
+    async def one():
+        started = time.perf_counter()
+        first = None
+        async for text in stream_function(MESSAGES):
+            if first is None and text:
+                first = time.perf_counter()
+        return started, first, time.perf_counter()
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(loop_probe(stop))
+    start = time.perf_counter()
+    streams = await asyncio.gather(*(one() for _ in range(count)))
+    wall = time.perf_counter() - start
+    stop.set()
+    await get_client_registry().aclose()
+    return {**summarize(implementation, streams, wall), "max_loop_stall_ms": round(await probe * 1000, 3)}
+
+
+async def run_askpdf(url: str, count: int) -> dict:
+    import websockets
+    from benchmarks.synthetic_pdfs import generate_pdf
+
+    pdf_path = os.path.join(tempfile.mkdtemp(prefix="stream_bench_"), "policy.pdf")
+    generate_pdf(pdf_path, "text", 2)
+    with open(pdf_path, "rb") as f:
+        question = json.dumps({"message": MESSAGES[0]["content"],
+                               "file": {"name": "policy.pdf", "type": "application/pdf", "content": base64.b64encode(f.read()).decode()}})
+
+    async def one():
+        async with websockets.connect(url, max_size=None) as websocket:
+            started = time.perf_counter()
+            first = None
+            await websocket.send(question)
+            while True:
+                frame = await websocket.recv()
+                if frame.startswith('{"type":"done"') or frame.startswith('{"type":"error"'):
+                    return started, first, time.perf_counter()
+                if first is None and frame:
+                    first = time.perf_counter()
+
+    start = time.perf_counter()
+    streams = await asyncio.gather(*(one() for _ in range(count)))
+    return summarize("askpdf", streams, time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", default="direct", choices=["direct", "askpdf"])
+    parser.add_argument("--streams", type=int, default=30)
+    parser.add_argument("--implementations", nargs="+", default=["async", "blocking"], choices=["async", "blocking"])
+    parser.add_argument("--url", default="ws://127.0.0.1:8080/askpdf")
+    parser.add_argument("--fake-port", type=int, default=0, help="port of the fake Groq server, fixed for --target askpdf")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="seconds between tokens")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    from benchmarks.standins import FakeGroqServer
+    from Rag.groq_keys import GROQ_REQUESTS_PER_MINUTE, GROQ_TOKENS_PER_MINUTE
+
+    server = FakeGroqServer(latency=args.llm_latency, token_latency=args.token_latency, port=args.fake_port,
+                            tokens_per_minute=GROQ_TOKENS_PER_MINUTE, requests_per_minute=GROQ_REQUESTS_PER_MINUTE).start()
+    print(f"fake groq server at {server.url}", file=sys.stderr)
+    # everything the Rag modules read at import time has to be set first
+    os.environ.update({
+        "GROQ_BASE_URL": server.url,
+        "GROQ_API_BASE": server.url,
+        "GROQ_API_KEYS_str": "bench-key-1,bench-key-2,bench-key-3",
+    })
+
+    if args.target == "askpdf":
+        results = [asyncio.run(run_askpdf(args.url, args.streams))]
+    else:
+        results = []
+        for implementation in args.implementations:
+            results.append(asyncio.run(run_direct(implementation, args.streams)))
+            print(f"{implementation} done", file=sys.stderr)
+    server.stop()
+
+    report = json.dumps({"created": time.time(), "target": args.target, "llm_latency": args.llm_latency,
+                         "token_latency": args.token_latency, "results": results}, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import io
+import random
+from PIL import Image, ImageDraw, ImageFont
+
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in points
+SCAN_DPI = 150
+LINES_PER_PAGE = 40
+
+SUBJECTS = ["The employee", "Each department", "The competent authority", "A contractor", "The reporting officer",
+            "The policy owner", "Every unit head", "The HR department", "The finance wing", "A project manager"]
+VERBS = ["shall submit", "must approve", "may request", "is required to record", "shall review",
+         "will reimburse", "must retain", "shall notify", "may delegate", "is entitled to"]
+OBJECTS = ["the leave application", "form HR-{n}", "the travel claim", "clause {c}.{s} compliance records",
+           "the annual performance report", "the data loss prevention checklist", "the LTC advance",
+           "medical reimbursement bills", "the vendor registration form", "the security clearance"]
+TAILS = ["within {d} days.", "before the end of the financial year.", "as per GAIL policy {c}.{s}.",
+         "through the ERP portal.", "with prior approval of the HOD.", "in triplicate.", "without exception."]
+
+
+def policy_sentence(rng: random.Random) -> str:
+    fill = {"n": rng.randint(1, 99), "c": rng.randint(1, 20), "s": rng.randint(1, 9), "d": rng.choice([7, 15, 30, 90])}
+    return " ".join([rng.choice(SUBJECTS), rng.choice(VERBS), rng.choice(OBJECTS).format(**fill), rng.choice(TAILS).format(**fill)])
+
+
+def page_lines(rng: random.Random, page_number: int, lines: int = LINES_PER_PAGE) -> list:
+    # ~80 character lines of policy-like prose with clause numbers and form codes
+    text = [f"Section {page_number}. Policy provisions"]
+    line = ""
+    while len(text) < lines:
+        for word in policy_sentence(rng).split():
+            if len(line) + len(word) > 80:
+                text.append(line)
+                line = ""
+            line = f"{line} {word}".strip()
+    return text[:lines]
+
+
+def render_scan(lines: list) -> Image.Image:
+    width, height = PAGE_WIDTH * SCAN_DPI // 72, PAGE_HEIGHT * SCAN_DPI // 72
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.load_default(size=22)
+    except TypeError:
+        font = ImageFont.load_default()
+    for i, line in enumerate(lines):
+        draw.text((90, 90 + i * 38), line, fill=0, font=font)
+    return image
+
+
+def pdf_string(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, pages: list) -> None:
+    """
+    Writes a pdf from pages given as ("text", lines) for a real text layer or
+    ("image", PIL image) for an image-only page, like a scan without OCR.
+    """
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    def add_stream(dictionary: str, data: bytes) -> int:
+        return add(f"<< {dictionary} /Length {len(data)} >>\nstream\n".encode() + data + b"\nendstream")
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = add(b"")
+    kids = []
+
+    for kind, content in pages:
+        if kind == "text":
+            operations = ["BT", "/F1 10 Tf", "14 TL", "50 800 Td"] + [f"({pdf_string(line)}) Tj T*" for line in content] + ["ET"]
+            stream = add_stream("", "\n".join(operations).encode("latin-1", "replace"))
+            resources = f"<< /Font << /F1 {font} 0 R >> >>"
+        else:
+            buffer = io.BytesIO()
+            content.convert("L").save(buffer, "JPEG", quality=75)
+            image = add_stream(f"/Type /XObject /Subtype /Image /Width {content.width} /Height {content.height} "
+                               "/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /DCTDecode", buffer.getvalue())
+            stream = add_stream("", f"q {PAGE_WIDTH} 0 0 {PAGE_HEIGHT} 0 0 cm /Im0 Do Q".encode())
+            resources = f"<< /XObject << /Im0 {image} 0 R >> >>"
+
+        kids.append(add(f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                        f"/Resources {resources} /Contents {stream} 0 R >>".encode()))
+
+    objects[pages_id - 1] = f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>".encode()
+    catalog = add(f"<< /Type /Catalog /Pages {pages_id} 0 R >>".encode())
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    output += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root {catalog} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+def corpus_pages(page_count: int, seed: int = 0) -> list:
+    # the text of a synthetic document, one list of lines per page
+    rng = random.Random(seed)
+    return [page_lines(rng, number) for number in range(1, page_count + 1)]
+
+
+def generate_pdf(path: str, kind: str, page_count: int, seed: int = 0) -> None:
+    """
+    kind is "text" (born digital), "scanned" (image-only pages) or "mixed" (every third page scanned).
+    """
+    pages = []
+    for number, lines in enumerate(corpus_pages(page_count, seed), start=1):
+        scanned = kind == "scanned" or (kind == "mixed" and number % 3 == 0)
+        pages.append(("image", render_scan(lines)) if scanned else ("text", lines))
+    write_pdf(path, pages)
@@ -6,8 +6,12 @@ export const useWebSocket = ({ url }) => {
   const [response, setResponse] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const [responseTime, setResponseTime] = useState(0);
+  const [timeToFirstToken, setTimeToFirstToken] = useState(null);
+  const [sources, setSources] = useState([]);
+  const [timings, setTimings] = useState(null);
 
   const startTimeRef = useRef(null);
+  const sentTimeRef = useRef(null);
   const timerRef = useRef(null);
 
   const connect = useCallback(() => {
@@ -26,8 +30,19 @@ export const useWebSocket = ({ url }) => {
     };
 
     ws.onmessage = (event) => {
+      // the answer streams in as text frames and ends with {"type":"done", ...}
+      if (typeof event.data === 'string' && event.data.startsWith('{"type":"done"')) {
+        const done = JSON.parse(event.data);
+        setSources(done.sources || []);
+        setTimings(done.timings || null);
+        setIsLoading(false);
+        return;
+      }
 
       if (!startTimeRef.current) {
+        if (sentTimeRef.current) {
+          setTimeToFirstToken((Date.now() - sentTimeRef.current) / 1000);
+        }
         startTimeRef.current = Date.now();
 
         timerRef.current = setInterval(() => {
@@ -62,7 +77,11 @@ export const useWebSocket = ({ url }) => {
         setIsLoading(true);
         setResponse('');
         startTimeRef.current = null;
+        sentTimeRef.current = Date.now();
         setResponseTime(0);
+        setTimeToFirstToken(null);
+        setSources([]);
+        setTimings(null);
 
         // Stop any existing timer
         if (timerRef.current) {
@@ -96,10 +115,17 @@ export const useWebSocket = ({ url }) => {
     isConnected,
     isLoading,
     responseTime,
+    timeToFirstToken,
+    sources,
+    timings,
     reset: () => {
       setResponse('');
       setResponseTime(0);
+      setTimeToFirstToken(null);
+      setSources([]);
+      setTimings(null);
       startTimeRef.current = null;
+      sentTimeRef.current = null;
       if (timerRef.current) {
         clearInterval(timerRef.current);
         timerRef.current = null;
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from langchain_community.document_loaders import PDFPlumberLoader
 import pdfplumber
@@ -5,24 +6,27 @@ from pathlib import Path
 import tempfile
 import subprocess
 import uuid 
-from groq import Groq
+from Rag.clients import get_client_registry
 from dotenv import load_dotenv
+from Rag.groq_keys import estimate_tokens, get_key_scheduler
 
 load_dotenv()
 
-groq_api = os.getenv("GROQ_API_KEY1")
-
-def generate_async(messages):
-    client = Groq(api_key = groq_api)
-    completion = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=messages,
-        temperature=0.4,
-        max_tokens=1024,
-        top_p=0.9,
-        stream=False,
-        stop=None,
-    )
+async def generate_async(messages):
+    # on the pooled async client, waiting for a key with capacity doesn't block the event loop
+    def create(api_key):
+        client = get_client_registry().async_groq(api_key)
+        return client.chat.completions.create(
+            model="llama-3.1-8b-instant",
+            messages=messages,
+            temperature=0.4,
+            max_tokens=1024,
+            top_p=0.9,
+            stream=False,
+            stop=None,
+        )
+    estimated_tokens = estimate_tokens(*(message["content"] for message in messages), max_tokens=1024)
+    completion = await get_key_scheduler().arun(create, estimated_tokens)
     return completion.choices[0].message.content
 
 desc_prompt = """
@@ -54,7 +58,7 @@ Requirements for the code:
 Return only the executable Python code without any explanations.
 """
 
-def generate_graph(data, user_query):
+async def generate_graph(data, user_query):
     save_dir = "graph/output.png"
     prompt1 = userprompt.format(data=data, question=user_query, save_path=save_dir)
     messages=[
@@ -67,7 +71,7 @@ def generate_graph(data, user_query):
             "content": prompt1,
         }
     ]
-    response = generate_async(messages)
+    response = await generate_async(messages)
 
     instructions = response.replace('```python', '').replace('```', '').strip()
     print(instructions)
@@ -76,7 +80,7 @@ def generate_graph(data, user_query):
         temp_file.write(instructions.encode('utf-8'))
         temp_file_path = temp_file.name
         try:
-            result = subprocess.run(['python', temp_file_path], capture_output=True, text=True)
+            result = await asyncio.to_thread(subprocess.run, ['python', temp_file_path], capture_output=True, text=True)
 
             if result.returncode != 0:
                 print(f"Error executing the code:\n{result.stderr}")
@@ -98,4 +102,4 @@ def generate_graph(data, user_query):
             "content": prompt,
         }
     ]
-    return generate_async(message)
\ No newline at end of file
+    return await generate_async(message)
\ No newline at end of file
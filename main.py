@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect, File, UploadFile, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect, File, Form, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from sqlalchemy import create_engine, MetaData, Table, insert, delete, func, update
@@ -12,7 +12,7 @@ import bcrypt, jwt, json,logging, uvicorn, os, uuid
 from datetime import datetime, timedelta
 from pyotp import TOTP
 from auth.two_factor_auth import SECRET_KEY, ALGORITHM, oauth2_scheme, send_otp_via_email, create_access_token, generate_totp_secret, send_otp_via_sms
-from Rag.llm_res import setup_model, llm_response
+from Rag.llm_res import setup_model
 from profanity.profantiy_detector import profanity_detector, build_trie
 from ws.ws_setup import WebSocketConnectionManager
 from db_files.chat_history import generate_chat_summary
@@ -25,7 +25,6 @@ from sqlalchemy.dialects.postgresql import JSONB
 import functools
 from redis import Redis
 from sqlalchemy.exc import SQLAlchemyError
-from groq import Groq
 from PIL import Image
 from dotenv import load_dotenv
 import pandas as pd
@@ -533,7 +532,17 @@ async def websocket_endpoint(websocket: WebSocket):
                     session_memory.append(
                         {'user': {user_message}, 'chat': {bot_response}}
                     )
-                response =  llm_response(message)
+                # the answer goes out as it is generated, text frames and then the {"type": "done", ...} message
+                parts = []
+                # closed right away if the socket drops, so the generation and its key slot are released
+                async with aclosing(model.llm_response(query=message, scope=message_data.get("scope"))) as stream:
+                    async for part in stream:
+                        if isinstance(part, dict):
+                            await websocket.send_json(part)
+                        else:
+                            parts.append(part)
+                            await websocket.send_text(part)
+                response = "".join(parts)
                 
                 # Prepare chat entry
                 chat_entry = {
@@ -549,13 +558,6 @@ async def websocket_endpoint(websocket: WebSocket):
                 await redis.lpush(redis_key, json.dumps(chat_entry))
                 await redis.expire(redis_key, timedelta(hours=1))
                 
-                # Send response back
-                await websocket.send_text(json.dumps({
-                    "response": response,
-                    # "timestamp": chat_entry["timestamp"],
-                    # "bot_mode": bot_mode
-                }))
-                
                 #logger.debug(f"Response sent: {response}")
             
 
@@ -872,12 +874,23 @@ def fetch_pinned_chats(username):
 
 from pathlib import Path
 import shutil
+import time
+from contextlib import aclosing
 from datetime import datetime
 from typing import List
 import base64
 import pdfplumber
 import io
 import Rag.model as model
+from Rag.jobs import IngestionQueue
+from Rag.clients import get_client_registry
+from Rag.coalesce import get_single_flight
+from Rag.streaming import stream_chat_completion
+from Rag.groq_keys import estimate_tokens, get_key_scheduler
+from Rag.vector_db import get_embedding_service, get_vector_db
+from Rag.bm25 import get_bm25_index
+from Rag.answer_cache import get_answer_cache
+from Rag.ocr import shutdown_ocr_pool
 
 UPLOAD_DIR = Path("files")
 UPLOAD_DIR.mkdir(exist_ok=True)
@@ -887,36 +900,98 @@ groq_api = os.environ["GROQ_API_KEY"]
 
 logger.info(groq_api)
 
+# documents uploaded through /pdfupload are ingested in the background by this queue
+INGESTION_QUEUE = IngestionQueue(ingest=model.add_document)
+
+
+@app.on_event("startup")
+async def start_ingestion_queue():
+    INGESTION_QUEUE.start()
+
+
+@app.on_event("shutdown")
+async def stop_ingestion_queue():
+    await INGESTION_QUEUE.stop()
+
+
+# one chroma client and collection handle for the whole process
+@app.on_event("startup")
+async def start_vector_db():
+    await get_vector_db().start()
+
+
+@app.on_event("shutdown")
+async def stop_vector_db():
+    await get_vector_db().close()
+
+
+# keep-alive LLM client pools per Groq key, closed with the process
+@app.on_event("startup")
+async def start_llm_clients():
+    get_client_registry().start(list(get_key_scheduler().states))
+
+
+@app.on_event("shutdown")
+async def stop_llm_clients():
+    await get_client_registry().aclose()
+    await get_single_flight().close()
+
+
+# the OCR worker processes are shared by every ingestion job
+@app.on_event("shutdown")
+async def stop_ocr_pool():
+    await asyncio.to_thread(shutdown_ocr_pool)
+
+
+@app.get("/metrics/vector_db")
+async def vector_db_metrics():
+    return get_vector_db().latency_metrics()
+
+@app.get("/metrics/embeddings")
+async def embedding_metrics():
+    return get_embedding_service().stats()
+
+@app.get("/metrics/llm_clients")
+async def llm_client_metrics():
+    return get_client_registry().stats()
+
+@app.get("/metrics/rag")
+async def rag_metrics():
+    # retrieval, time_to_first_token and total latency of the answers
+    return model.rag_metrics()
+
+@app.get("/metrics/answer_cache")
+async def answer_cache_metrics():
+    return await asyncio.to_thread(get_answer_cache().stats)
+
+def message_tokens(messages, max_tokens):
+    return estimate_tokens(*(message["content"] for message in messages), max_tokens=max_tokens)
+
 async def stream_generate_async(messages):
-    client = Groq(api_key = groq_api)
-    completion = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=messages,
-        temperature=0.4,
-        max_tokens=1024,
-        top_p=0.9,
-        stream=True,
-        stop=None,
-    )
-    for chunk in completion:
-        yield chunk.choices[0].delta.content or ""
-        await asyncio.sleep(0)
-
-def generate_async(messages):
-    client = Groq(api_key = groq_api)
-    completion = client.chat.completions.create(
-        model="gemma2-9b-it",
-        messages=messages,
-        temperature=0.4,
-        max_tokens=1024,
-        top_p=0.9,
-        stream=False,
-        stop=None,
-    )
+    # text deltas as they arrive, read on the pooled async client without blocking the event loop
+    stream = stream_chat_completion(messages, model="llama-3.1-8b-instant", max_tokens=1024, temperature=0.4, top_p=0.9)
+    async with aclosing(stream):
+        async for text in stream:
+            yield text
+
+async def generate_async(messages):
+    # on the pooled async client, waiting for a key with capacity doesn't block the event loop
+    def create(api_key):
+        client = get_client_registry().async_groq(api_key)
+        return client.chat.completions.create(
+            model="gemma2-9b-it",
+            messages=messages,
+            temperature=0.4,
+            max_tokens=1024,
+            top_p=0.9,
+            stream=False,
+            stop=None,
+        )
+    completion = await get_key_scheduler().arun(create, message_tokens(messages, 1024))
     print("test99")
     return completion.choices[0].message.content
 
-def formatter(msg):
+async def formatter(msg):
     prompt = """Format the following text to make it more readable:
 
         {unformatted_text}
@@ -943,16 +1018,18 @@ def formatter(msg):
             "content": prompt,
         }
     ]
-    client = Groq(api_key = groq_api)
-    completion = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=messages,
-        temperature=0.4,
-        max_tokens=4096,
-        top_p=0.9,
-        stream=True,
-        stop=None,
-    )
+    def create(api_key):
+        client = get_client_registry().async_groq(api_key)
+        return client.chat.completions.create(
+            model="llama-3.3-70b-versatile",
+            messages=messages,
+            temperature=0.4,
+            max_tokens=4096,
+            top_p=0.9,
+            stream=False,
+            stop=None,
+        )
+    completion = await get_key_scheduler().arun(create, message_tokens(messages, 4096))
 
     return completion.choices[0].message.content
     
@@ -986,7 +1063,6 @@ async def websocket_askpdf(websocket: WebSocket):
                 file_type = file_data["type"]
                 if file_type == 'application/pdf':
                     pdf_file = io.BytesIO(file_content)
-                    image=Image.open(pdf_file)
                     # text = pytesseract.image_to_string(image)
                     text =""
                     with pdfplumber.open(pdf_file) as pdf:
@@ -1051,8 +1127,17 @@ async def websocket_askpdf(websocket: WebSocket):
                         "content": prompt,
                     }
                 ]
-                async for chunk in stream_generate_async(messages):
-                    await websocket.send_text(chunk)
+                # a send failing on a closed socket closes the stream, which cancels the generation and frees the key
+                started = time.perf_counter()
+                first_token_ms = None
+                stream = stream_generate_async(messages)
+                async with aclosing(stream):
+                    async for chunk in stream:
+                        if first_token_ms is None and chunk:
+                            first_token_ms = round((time.perf_counter() - started) * 1000, 3)
+                        await websocket.send_text(chunk)
+                await websocket.send_json({"type": "done", "source_chunk_ids": [], "sources": [],
+                                           "timings": {"time_to_first_token_ms": first_token_ms, "total_ms": round((time.perf_counter() - started) * 1000, 3)}})
 
                 continue
 
@@ -1089,7 +1174,7 @@ async def websocket_askpdf(websocket: WebSocket):
                     }
                 ]
                 print("test2")
-                mode = generate_async(messages).strip()
+                mode = (await generate_async(messages)).strip()
                 print(mode)
                 
                 if mode.endswith(".txt"):
@@ -1101,7 +1186,15 @@ async def websocket_askpdf(websocket: WebSocket):
                 
             else:
                 # ansformat= await model.llm_response(query=query)
-                await websocket.send_text(await model.llm_response(query=query))
+                # optional "scope": {"doc_name": ..., "category": ...}, a name or a list of names each
+                # streamed as text frames, closed by a {"type": "done", ...} message with sources and timings
+                parts = model.llm_response(query=query, scope=question.get("scope"))
+                async with aclosing(parts):
+                    async for part in parts:
+                        if isinstance(part, dict):
+                            await websocket.send_json(part)
+                        else:
+                            await websocket.send_text(part)
             
             # async for chunk in formatter(ansformat):
             #     await websocket.send_text(chunk)
@@ -1119,30 +1212,52 @@ async def websocket_askpdf(websocket: WebSocket):
 
 
 @app.post("/pdfupload")
-async def upload_documents(documents: List[UploadFile] = File(...)):
+async def upload_documents(documents: List[UploadFile] = File(...), category: str = Form(None)):
     saved_files = []
 
     for upload_file in documents:
-        file_path = UPLOAD_DIR / upload_file.filename
+        # every upload gets its own file, a re-upload of the same name must not rewrite a file an earlier job is still reading
+        file_path = UPLOAD_DIR / f"{uuid.uuid4().hex}_{upload_file.filename}"
         
         # Save the file
         with file_path.open("wb") as buffer:
             shutil.copyfileobj(upload_file.file, buffer)
         
+        job_id = INGESTION_QUEUE.submit(file_path=str(file_path), file_name=upload_file.filename, category=category)
+
         saved_files.append({
             "original_name": upload_file.filename,
-            "saved_path": str(file_path)
+            "saved_path": str(file_path),
+            "job_id": job_id
         })
 
-        await model.add_document(file_path=f'{UPLOAD_DIR}/{upload_file.filename}', file_name=upload_file.filename)
-
 
     return {
-        "message": "Upload successful",
+        "message": "Upload successful, ingestion started",
         "files": saved_files
     }
 
 
+@app.get("/pdfupload/jobs")
+async def list_ingestion_jobs(limit: int = 50):
+    return {"jobs": INGESTION_QUEUE.list(limit=limit)}
+
+
+@app.get("/pdfupload/jobs/{job_id}")
+async def get_ingestion_job(job_id: str):
+    job = INGESTION_QUEUE.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    return job
+
+
+@app.get("/documents")
+async def list_documents():
+    # what questions can be scoped to, with the number of chunks of each
+    values = await asyncio.to_thread(get_bm25_index().field_values)
+    return {"documents": values["doc_name"], "categories": values["category"]}
+
+
 @app.post('/system_dict')
 def AddWordToSystemDict(word):
     #add to system dict txt file
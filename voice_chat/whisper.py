@@ -1,5 +1,5 @@
-import openai
 import os
+from Rag.clients import get_client_registry
 from gtts import gTTS
 
 
@@ -10,10 +10,7 @@ store_location='audio_files/txt_to_speech'
 api_key= os.getenv("OPENAI_API_KEY")
 
 def transcribe_audio_whisper(file_path):
-    client = openai.OpenAI(
-    base_url="https://api.groq.com/openai/v1",
-    api_key=os.environ.get("GROQ_API_KEY")
-)
+    client = get_client_registry().openai(os.environ.get("GROQ_API_KEY"))
     try:
         # Open the audio file
         with open(file_path, "rb") as audio_file: